@@ -0,0 +1,688 @@
+#!/usr/bin/env python3
+"""
+Benchmarks and known-answer checks for rdp-cred-sniffer.py
+
+Synthetic PDUs of all kinds the sniffer looks at are generated here and run
+through its hot paths. The results are in ops/s and MB/s, use --json to
+compare runs.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import random
+import struct
+import subprocess
+import sys
+import time
+
+from seth import crypto, extractors, framing, pipeline, tamper
+
+
+CLIENT_RANDOM = bytes(range(32))
+SERVER_RANDOM = bytes(range(32, 64))
+SERVER_CHALLENGE = bytes.fromhex("1122334455667788")
+# Import times are measured for these, each in a new interpreter
+IMPORTS = ["seth", "seth.framing", "seth.crypto", "seth.extractors",
+           "seth.pipeline", "seth.recording", "seth.certs", "seth.proxy",
+           "seth.cli"]
+SNIFFER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       "rdp-cred-sniffer.py")
+NT_PROOF = bytes(range(16))
+CREDENTIALS = ("LAB", "alice", "S3cret!")
+
+
+# Generator
+
+def tpkt(payload):
+    return struct.pack(">BBH", 3, 0, len(payload)+4) + payload
+
+
+def x224_data(payload):
+    return tpkt(b"\x02\xf0\x80" + payload)
+
+
+def per_length(length):
+    if length < 0x80:
+        return bytes([length])
+    return struct.pack(">H", 0x8000 | length)
+
+
+def ber(tag, content):
+    length = len(content)
+    if length < 0x80:
+        header = bytes([length])
+    elif length < 0x100:
+        header = b"\x81" + bytes([length])
+    else:
+        header = b"\x82" + struct.pack(">H", length)
+    return bytes([tag]) + header + content
+
+
+def send_data_request(payload, channel=1003, initiator=1007):
+    # T.125 MCS Send Data Request
+    return x224_data(b"\x64" + struct.pack(">HH", initiator-1001, channel) +
+                     b"\x70" + per_length(len(payload)) + payload)
+
+
+def encrypted_send_data(payload, flags, rc4):
+    """Send Data Request with a basic security header, encrypted with rc4"""
+    # Ch. 2.2.8.1.1.2.1
+    return send_data_request(struct.pack("<HH", flags | 0x0008, 0) +
+                             b"\x00"*8 + bytes(rc4.decrypt(payload)))
+
+
+def connection_request(protocols=3):
+    # Ch. 2.2.1.1
+    return tpkt(b"\x0e\xe0\x00\x00\x00\x00\x00" +
+                b"Cookie: mstshash=bench\r\n" +
+                struct.pack("<BBHI", 1, 0, 8, protocols))
+
+
+def connection_confirm(protocol=0):
+    # Ch. 2.2.1.2
+    return tpkt(b"\x0e\xd0\x00\x00\x12\x34\x00" +
+                struct.pack("<BBHI", 2, 0, 8, protocol))
+
+
+def sign(data, length=64+8):
+    """Sign a proprietary certificate like a terminal server does"""
+    m = hashlib.md5(data).digest() + b"\x00" + b"\xff"*45 + b"\x01"
+    m = int.from_bytes(m, "little")
+    s = pow(m, crypto.TERM_KEY.d, crypto.TERM_KEY.n)
+    return s.to_bytes(length, "little")
+
+
+def proprietary_certificate(key):
+    # Ch. 2.2.1.4.3.1.1
+    modulus = key.n.to_bytes(key.size, "little") + b"\x00"*8
+    pubkey_blob = (b"RSA1" + struct.pack("<IIII", len(modulus),
+                                          key.size*8, key.size-1, key.e) +
+                   modulus)
+    first5fields = struct.pack("<IIIHH", 1, 1, 1, 6, len(pubkey_blob))
+    signature = sign(first5fields + pubkey_blob)
+    return (first5fields + pubkey_blob +
+            struct.pack("<HH", 8, len(signature)) + signature)
+
+
+def mcs_connect_response(key=None, protocol=0):
+    """MCS Connect Response with the server core, network and security data,
+    the latter has a proprietary certificate unless key is None"""
+    # Ch. 2.2.1.4
+    core = struct.pack("<HHIII", 0x0c01, 16, 0x00080004, protocol, 0)
+    net = struct.pack("<HHHH", 0x0c03, 8, 1003, 0)
+    if key is None:
+        security = struct.pack("<II", 0, 0)
+    else:
+        cert = proprietary_certificate(key)
+        security = (struct.pack("<IIII", 2, 2, len(SERVER_RANDOM), len(cert)) +
+                    SERVER_RANDOM + cert)
+    security = struct.pack("<HH", 0x0c02, len(security)+4) + security
+    user_data = core + net + security
+    gcc = (b"\x00\x05\x00\x14\x7c\x00\x01\x2a\x14\x76\x0a\x01\x01\x00\x01"
+           b"\xc0\x00McDn" + per_length(len(user_data)) + user_data)
+    body = (b"\x0a\x01\x00\x02\x01\x00\x30\x1a\x02\x01\x22\x02\x01\x03\x02"
+            b"\x01\x00\x02\x01\x01\x02\x01\x00\x02\x01\x01\x02\x03\x00\xff"
+            b"\xf8\x02\x01\x02\x04\x82" + struct.pack(">H", len(gcc)) + gcc)
+    return x224_data(b"\x7f\x66\x82" + struct.pack(">H", len(body)) + body)
+
+
+def security_exchange(key):
+    """Security Exchange PDU with CLIENT_RANDOM encrypted for key"""
+    # Ch. 2.2.1.10
+    encrypted = crypto.rsa_encrypt(CLIENT_RANDOM, key) + b"\x00"*8
+    return send_data_request(struct.pack("<HHI", 0x0001, 0, len(encrypted)) +
+                             encrypted)
+
+
+def client_info(domain=CREDENTIALS[0], user=CREDENTIALS[1],
+                password=CREDENTIALS[2]):
+    # Ch. 2.2.1.11
+    domain, user, password = [x.encode("utf-16-le")
+                              for x in (domain, user, password)]
+    info = (struct.pack("<II", 0, 0x00000233) +
+            struct.pack("<HHHHH", len(domain), len(user), len(password), 0, 0)
+            + domain + b"\0\0" + user + b"\0\0" + password + b"\0\0" +
+            b"\0\0" + b"\0\0")
+    payload = struct.pack("<HH", 0x0040, 0) + info
+    return x224_data(b"\x64\x00\x06\x03\xeb\x70" +
+                     struct.pack(">H", 0x8000 | len(payload)) + payload)
+
+
+def confirm_active(layout=0x407):
+    """Confirm Active PDU with a General and an Input Capability Set"""
+    # Ch. 2.2.1.13.2
+    general = struct.pack("<HH", 1, 24) + b"\x00"*20
+    inp = (struct.pack("<HHHHIIII", 0x0d, 88, 0x35, 0, layout, 4, 0, 12) +
+           b"\x00"*64)
+    caps = general + inp
+    pdu = (struct.pack("<HHH", 0, 0x13, 1007) +
+           struct.pack("<IHHH", 0x103ea, 1002, 4, len(caps)+4) + b"MSTSC\0" +
+           struct.pack("<HH", 2, 0) + caps)
+    return send_data_request(struct.pack("<H", len(pdu)+2) + pdu)
+
+
+def ts_request(token):
+    # [MS-CSSP] Ch. 2.2.1
+    nego_data = ber(0x30, ber(0x30, ber(0xa0, ber(0x04, token))))
+    return ber(0x30, ber(0xa0, b"\x02\x01\x06") + ber(0xa1, nego_data))
+
+
+def ntlm_challenge(challenge=SERVER_CHALLENGE):
+    # [MS-NLMP] Ch. 2.2.1.2
+    target = "LAB".encode("utf-16-le")
+    return ts_request(
+        b"NTLMSSP\x00\x02\x00\x00\x00" +
+        struct.pack("<HHI", len(target), len(target), 56) +
+        struct.pack("<I", 0xe2898215) + challenge + b"\x00"*8 +
+        struct.pack("<HHI", 0, 0, 56+len(target)) +
+        b"\x0a\x00\x63\x45\x00\x00\x00\x0f" + target
+    )
+
+
+def ntlm_authenticate(domain=CREDENTIALS[0], user=CREDENTIALS[1],
+                      workstation="WS01"):
+    # [MS-NLMP] Ch. 2.2.1.3
+    nt_response = (NT_PROOF + b"\x01\x01\x00\x00" + b"\x00"*4 + b"\x99"*8 +
+                   b"\xaa"*8 + b"\x00"*8)
+    fields = [b"\x00"*24, nt_response] + [
+        x.encode("utf-16-le") for x in (domain, user, workstation)
+    ] + [b""]
+    header = b""
+    payload = b""
+    offset = 88
+    for field in fields:
+        header += struct.pack("<HHI", len(field), len(field), offset)
+        payload += field
+        offset += len(field)
+    return ts_request(b"NTLMSSP\x00\x03\x00\x00\x00" + header +
+                      struct.pack("<I", 0xe2888215) +
+                      b"\x0a\x00\x63\x45\x00\x00\x00\x0f" + b"\x00"*16 +
+                      payload)
+
+
+def fast_path(action, body, rc4=None):
+    """Wrap body into a fast-path PDU, encrypted if rc4 is given"""
+    # Ch. 2.2.8.1.2, 2.2.9.1.2
+    if rc4 is not None:
+        action |= 0x80
+        body = b"\x00"*8 + bytes(rc4.decrypt(body)) # RC4 is symmetric
+    length = 2 + len(body)
+    if length < 0x80:
+        return bytes([action, length]) + body
+    return bytes([action]) + struct.pack(">H", 0x8000 | (length+1)) + body
+
+
+def key_event(code, release=False):
+    # Ch. 2.2.8.1.2.2.1
+    return bytes([0x01 if release else 0x00, code])
+
+
+def unicode_event(char, release=False):
+    # Ch. 2.2.8.1.2.2.2
+    return bytes([0x81 if release else 0x80]) + struct.pack("<H", ord(char))
+
+
+def mouse_event(x, y, flags=0x0800):
+    # Ch. 2.2.8.1.2.2.3, PTRFLAGS_MOVE
+    return b"\x20" + struct.pack("<HHH", flags, x, y)
+
+
+def sync_event(flags=0):
+    # Ch. 2.2.8.1.2.2.5
+    return bytes([0x60 | flags])
+
+
+def fast_path_input(events, rc4=None):
+    if len(events) < 16:
+        return fast_path(len(events) << 2, b"".join(events), rc4)
+    # numEvents follows the header
+    return fast_path(0, bytes([len(events)]) + b"".join(events), rc4)
+
+
+def fast_path_bitmap(size=16000, seed=0, rc4=None):
+    """A fast-path bitmap update, random data doesn't compress anyway"""
+    # Ch. 2.2.9.1.2.1
+    data = random.Random(seed).randbytes(size)
+    return fast_path(0, b"\x01" + struct.pack("<H", len(data)) + data, rc4)
+
+
+# Sessions
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+
+def rdp_security_session():
+    """Run the Standard RDP Security handshake through a new session.
+    Returns the session, the target's key and RC4 instances that encrypt
+    like the client and the server do"""
+    session = pipeline.Session()
+    session.phase = framing.PHASE_MCS_CONNECT
+    server_key = crypto.generate_rsa_key(512)
+    pdu = mcs_connect_response(server_key)
+    hits = pipeline.parse_rdp_packet(session, pdu, From="Server")
+    forged = tamper.tamper_data(session, pdu, From="Server", hits=hits)
+    pdu = security_exchange(session.crypto["mykey"])
+    hits = pipeline.parse_rdp_packet(session, pdu, From="Client")
+    reencrypted = tamper.tamper_data(session, pdu, From="Client", hits=hits)
+    client = crypto.RC4(session.crypto["client_encrypt_key"])
+    server = crypto.RC4(session.crypto["server_encrypt_key"])
+    return session, server_key, forged, reencrypted, client, server
+
+
+def parse_output(session, pdus, From="Client"):
+    """Everything parse_rdp prints while parsing pdus"""
+    output = []
+    class Capture(object):
+        def write(self, s):
+            output.append(s)
+        def flush(self):
+            pass
+    with contextlib.redirect_stdout(Capture()):
+        for pdu in pdus:
+            pipeline.parse_rdp(session, pdu, From=From)
+    return "".join(output)
+
+
+# Known-answer checks
+
+def check_rc4():
+    # RFC 6229, key stream at offsets 0 and 1024
+    for key, stream in [
+        ("0102030405", "b2396305f03dc027ccc3524a0a1118a8"
+                       "30abbcc7c20b01609f23ee2d5f6bb7df"),
+        ("0102030405060708", "97ab8a1bf0afb96132f2f67258da15a8"
+                             "c6d0e7b226259fa9023490b26167ad1d"),
+        ("0102030405060708090a0b0c0d0e0f10",
+         "9ac7cc9a609d1ef7b2932899cde41b97"
+         "bdf0324e6083dcc6d3cedd3ca8c53c16"),
+    ]:
+        result = crypto.RC4(bytes.fromhex(key)).decrypt(bytes(1040))
+        if (result[:16] + result[1024:]).hex() != stream:
+            return False
+    return True
+
+
+def check_rc4_key_update():
+    # Ch. 5.3.7.1, the 4097th packet is encrypted with the updated key
+    rc4 = crypto.RC4(bytes(range(16)))
+    with quiet():
+        for _ in range(4097):
+            result = rc4.decrypt(bytes(16))
+    return (rc4.key.hex() == "e2a4bda35b1776767f79ec4a7ed1f5b6"
+            and bytes(result).hex() == "45970b2e3b418d7fac1ac14ba9722e1b")
+
+
+def check_session_keys():
+    # Ch. 5.3.5.1, non-FIPS with 128 bit keys
+    session = pipeline.Session()
+    session.crypto.update(client_rand=CLIENT_RANDOM, server_rand=SERVER_RANDOM)
+    with quiet():
+        crypto.generate_session_keys(session)
+    return (
+        session.crypto["mac_key"].hex() == "815370c6e31347c463ed25f1af48bbdf"
+        and session.crypto["server_encrypt_key"].hex() ==
+            "1cb207f61b7cd10dca9ec78871d0a142"
+        and session.crypto["server_decrypt_key"].hex() ==
+            "702783c08474414a33a259c6faed480c"
+    )
+
+
+def check_rsa():
+    # The CRT must give the same result as the plain private exponent
+    key = crypto.TERM_KEY
+    m = int.from_bytes(hashlib.sha512(b"bench").digest()[:60], "little")
+    c = key.encrypt(m)
+    if not key.decrypt(c) == pow(c, key.d, key.n) == m:
+        return False
+    key = crypto.generate_rsa_key(512)
+    ciphertext = crypto.rsa_encrypt(CLIENT_RANDOM, key)
+    return crypto.rsa_decrypt(ciphertext, key) == CLIENT_RANDOM
+
+
+def check_sign_certificate():
+    data = proprietary_certificate(crypto.TERM_KEY)[:-76]
+    signature = crypto.sign_certificate(data, 72)
+    m = pow(int.from_bytes(signature, "little"), crypto.TERM_KEY.e,
+            crypto.TERM_KEY.n).to_bytes(63, "little")
+    return signature == sign(data) and m[:16] == hashlib.md5(data).digest()
+
+
+def check_rdp_security():
+    """Forged certificate, client random and decryption of the input"""
+    with quiet():
+        session, server_key, forged, reencrypted, client, _ = (
+            rdp_security_session()
+        )
+    if session.crypto["client_rand"] != CLIENT_RANDOM:
+        return False
+    # The client must accept the forged certificate...
+    offset = forged.find(b"RSA1")
+    first5fields = forged[offset-16:offset]
+    pubkey_blob = forged[offset:offset+20+session.crypto["mykey"].size+8]
+    signature = forged[offset+len(pubkey_blob)+4:]
+    if signature != sign(first5fields + pubkey_blob):
+        return False
+    # ... and the target must get the client random
+    encrypted = reencrypted[-8-server_key.size:-8]
+    if crypto.rsa_decrypt(encrypted, server_key) != CLIENT_RANDOM:
+        return False
+    output = parse_output(session, [
+        fast_path_input([key_event(code)], client)
+        for code in (0x1e, 0x30, 0x2e)
+    ])
+    return all("Key press:   %s" % k in output for k in "ABC")
+
+
+def check_input_events():
+    """All events of a PDU are decoded, keys according to the layout"""
+    session = pipeline.Session()
+    parse_output(session, [confirm_active(layout=0x407)])
+    events = [sync_event(), mouse_event(100, 200), key_event(0x15),
+              key_event(0x15, True), unicode_event("é"), key_event(0x48),
+              bytes([0x02, 0x48])] + [key_event(0x1e)] * 12
+    pdu = fast_path_input(events)
+    decoded = extractors.decode_input_events(pdu)
+    if len(decoded) != len(events) or decoded[1] != (
+            extractors.INPUT_MOUSE, 0x0800, 100, 200):
+        return False
+    output = parse_output(session, [pdu]).replace("\033[31m", "")
+    output = output.replace("\033[0m", "").splitlines()
+    return output[:6] == [
+        "Key press:   Z", "Key release:                 Z",
+        "Key press:   é", "Key press:   Up (8)", "Key press:   Up",
+        "Key press:   A",
+    ] and len(output) == 17
+
+
+def check_credentials():
+    output = parse_output(pipeline.Session(), [client_info()])
+    return "%s\\%s:%s" % CREDENTIALS in output
+
+
+def check_ntlmv2():
+    session = pipeline.Session()
+    output = parse_output(session, [ntlm_challenge()], From="Server")
+    output += parse_output(session, [ntlm_authenticate()])
+    return ("%s::%s:%s:%s:" % (CREDENTIALS[1], CREDENTIALS[0],
+                               SERVER_CHALLENGE.hex(), NT_PROOF.hex())
+            in output)
+
+
+def check_phases():
+    """A session only reaches the active phase after the whole handshake,
+    without missing anything on the way"""
+    session = pipeline.Session()
+    session.rdp_protocol = 3
+    session.phase = framing.PHASE_CREDSSP
+    output = parse_output(session, [ntlm_challenge()], From="Server")
+    output += parse_output(session, [ntlm_authenticate()])
+    output += parse_output(session, [mcs_connect_response(protocol=2)],
+                           From="Server")
+    if session.phase != framing.PHASE_CLIENT_INFO:
+        return False
+    output += parse_output(session, [client_info(), confirm_active()])
+    if session.phase != framing.PHASE_ACTIVE or not (
+            "%s\\%s:%s" % CREDENTIALS in output and
+            SERVER_CHALLENGE.hex() in output):
+        return False
+
+    with quiet():
+        session, _, _, _, client, _ = rdp_security_session()
+    if session.phase != framing.PHASE_CLIENT_INFO:
+        return False
+    parse_output(session, [encrypted_send_data(confirm_active()[15:], 0,
+                                               client)])
+    return (session.phase == framing.PHASE_ACTIVE and
+            session.keyboard_info["layout"] == 0x407)
+
+
+def check_fast_path_output():
+    """Graphics updates are not decrypted, but the RC4 state must stay in
+    sync, also across a key update"""
+    with quiet():
+        session, _, _, _, _, server = rdp_security_session()
+        for i in range(4100):
+            pipeline.parse_rdp(session, fast_path_bitmap(100, i, server),
+                              From="Server")
+        payload = b"\x01\x02\x03\x04" * 8
+        pdu = encrypted_send_data(payload, 0, server)
+        result = crypto.decrypt(session, pdu, From="Server")
+    return bytes(result[-len(payload):]) == payload
+
+
+def check_lazy_imports():
+    """Importing the parsers prints nothing and pulls in neither asyncio
+    nor the cryptography package"""
+    code = ("import sys, seth.pipeline, seth.recording; print(sorted("
+            "m for m in sys.modules if m.split('.')[0] in "
+            "('asyncio', 'cryptography', 'hexdump')))")
+    result = subprocess.run([sys.executable, "-c", code],
+                            cwd=os.path.dirname(SNIFFER),
+                            capture_output=True, text=True)
+    return result.stdout == "[]\n" and result.stderr == ""
+
+
+CHECKS = [
+    ("rc4", check_rc4),
+    ("rc4_key_update", check_rc4_key_update),
+    ("generate_session_keys", check_session_keys),
+    ("rsa", check_rsa),
+    ("sign_certificate", check_sign_certificate),
+    ("rdp_security", check_rdp_security),
+    ("input_events", check_input_events),
+    ("credentials", check_credentials),
+    ("ntlmv2", check_ntlmv2),
+    ("phases", check_phases),
+    ("fast_path_output", check_fast_path_output),
+    ("lazy_imports", check_lazy_imports),
+]
+
+
+# Benchmarks
+
+def benchmarks():
+    """Returns a list of (name, function, bytes per call)"""
+    with quiet():
+        session, _, _, _, client, server = rdp_security_session()
+    session.phase = framing.PHASE_ACTIVE
+    server_key = crypto.generate_rsa_key(512)
+    plain = {
+        "x224": (connection_request(), "Client"),
+        "mcs_connect_response": (mcs_connect_response(server_key), "Server"),
+        "client_info": (client_info(), "Client"),
+        "confirm_active": (confirm_active(), "Client"),
+        "ntlm_challenge": (ntlm_challenge(), "Server"),
+        "ntlm_authenticate": (ntlm_authenticate(), "Client"),
+        "fast_path_input": (fast_path_input([key_event(0x1e)]), "Client"),
+        "fast_path_input_batch": (fast_path_input(
+            [key_event(0x1e), key_event(0x1e, True), mouse_event(1, 2)] * 8),
+            "Client"),
+        "fast_path_bitmap": (fast_path_bitmap(), "Server"),
+    }
+    encrypted = {
+        "fast_path_input": (fast_path_input([key_event(0x1e)], client),
+                            "Client"),
+        "fast_path_bitmap": (fast_path_bitmap(rc4=server), "Server"),
+    }
+    result = []
+
+    def add(name, function, size):
+        result.append((name, function, size))
+
+    # Stateful PDUs need a new session each time, just like in real life.
+    # The session starts out checking for everything.
+    def parser(pdu, From, function, phase=framing.PHASE_NEGOTIATION):
+        def run():
+            session = pipeline.Session()
+            session.phase = phase
+            function(session, pdu, From=From)
+        return run
+
+    for name, (pdu, From) in plain.items():
+        add("parse_rdp_packet/" + name,
+            parser(pdu, From, pipeline.parse_rdp_packet), len(pdu))
+    for name in ["fast_path_input", "fast_path_input_batch",
+                 "fast_path_bitmap"]:
+        pdu, From = plain[name]
+        add("parse_rdp_packet/active_" + name,
+            parser(pdu, From, pipeline.parse_rdp_packet, framing.PHASE_ACTIVE),
+            len(pdu))
+    for name, (pdu, From) in plain.items():
+        with quiet():
+            s = pipeline.Session()
+            pipeline.parse_rdp_packet(s, pdu, From=From)
+        hits = framing.scan_pdu(pdu, From=From)
+        add("tamper_data/" + name,
+            lambda pdu=pdu, From=From, hits=hits, s=s:
+                tamper.tamper_data(s, pdu, From=From, hits=hits),
+            len(pdu))
+
+    stream = b"".join(fast_path_bitmap(seed=i) for i in range(16))
+    add("parse_rdp/bitmap_stream", parser(stream, "Server", pipeline.parse_rdp,
+                                          framing.PHASE_ACTIVE),
+        len(stream))
+    stream = b"".join(fast_path_input([key_event(code), key_event(code, True)])
+                      for code in range(0x10, 0x32))
+    add("parse_rdp/input_stream", parser(stream, "Client", pipeline.parse_rdp,
+                                         framing.PHASE_ACTIVE),
+        len(stream))
+    stream = b"".join(pdu for pdu, From in plain.values() if From == "Server")
+    add("parse_rdp/handshake", parser(stream, "Server", pipeline.parse_rdp),
+        len(stream))
+
+    for name, (pdu, From) in encrypted.items():
+        add("decrypt/" + name,
+            lambda pdu=pdu, From=From: crypto.decrypt(session, pdu, From=From),
+            len(pdu))
+        add("parse_rdp/encrypted_" + name,
+            lambda pdu=pdu, From=From:
+                pipeline.parse_rdp(session, pdu, From=From),
+            len(pdu))
+
+    rc4 = crypto.RC4(bytes(16))
+    for size in [16, 0x4000]:
+        data = bytearray(size)
+        add("RC4.decrypt/%d" % size,
+            lambda data=data: rc4.decrypt(data, data), size)
+
+    keys = pipeline.Session()
+    keys.crypto.update(client_rand=CLIENT_RANDOM, server_rand=SERVER_RANDOM)
+    add("generate_session_keys",
+        lambda: crypto.generate_session_keys(keys), 0)
+    cert = proprietary_certificate(server_key)[:-76]
+    add("sign_certificate", lambda: crypto.sign_certificate(cert, 72),
+        len(cert))
+    ciphertext = crypto.rsa_encrypt(CLIENT_RANDOM, server_key)
+    add("rsa_decrypt", lambda: crypto.rsa_decrypt(ciphertext, server_key),
+        len(ciphertext))
+    return result
+
+
+def measure(function, size, duration):
+    """Call function repeatedly for about duration seconds"""
+    calls = 0
+    batch = 1
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < duration:
+        for _ in range(batch):
+            function()
+        calls += batch
+        elapsed = time.perf_counter() - start
+        if elapsed < duration / 10:
+            batch *= 2
+    return {
+        "calls": calls,
+        "seconds": elapsed,
+        "ops_per_s": calls / elapsed,
+        "mb_per_s": calls * size / elapsed / 1e6,
+        "bytes": size,
+    }
+
+
+def measure_import(module, runs=5):
+    """Seconds it takes a new interpreter to import module, the best of
+    runs"""
+    code = ("import time; start = time.perf_counter(); import %s; "
+            "print(time.perf_counter() - start)" % module)
+    return min(
+        float(subprocess.check_output([sys.executable, "-c", code],
+                                      cwd=os.path.dirname(SNIFFER)))
+        for _ in range(runs)
+    )
+
+
+def measure_startup(arguments, runs=5):
+    """Seconds from starting the sniffer until it exits, the best of
+    runs"""
+    result = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, SNIFFER] + arguments,
+                       stdout=subprocess.DEVNULL, check=True)
+        result.append(time.perf_counter() - start)
+    return min(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks and known-answer checks for the sniffer")
+    parser.add_argument('-t', '--time', dest='duration', type=float,
+        default=0.5, help="seconds per benchmark (default 0.5)")
+    parser.add_argument('-j', '--json', dest='json', action="store_true",
+        default=False, help="print the results as JSON")
+    parser.add_argument('-c', '--check-only', dest='check_only',
+        action="store_true", default=False,
+        help="only run the known-answer checks")
+    parser.add_argument('filter', type=str, nargs='*',
+        help="only run benchmarks whose name contains one of these")
+    options = parser.parse_args()
+
+    report = {
+        "python": sys.version.split()[0],
+        "accelerated_rc4": (crypto.load_cryptography()
+                            and crypto.ARC4 is not None),
+        "checks": {name: check() for name, check in CHECKS},
+        "benchmarks": {},
+        "startup": {},
+    }
+    if not options.json:
+        for name, ok in report["checks"].items():
+            print("%-24s %s" % (name, "ok" if ok else "FAILED"))
+
+    if not options.check_only:
+        for name, function, size in benchmarks():
+            if options.filter and not any(f in name for f in options.filter):
+                continue
+            with quiet():
+                result = measure(function, size, options.duration)
+            report["benchmarks"][name] = result
+            if not options.json:
+                print("%-40s %12.0f ops/s %10.1f MB/s" % (
+                    name, result["ops_per_s"], result["mb_per_s"]))
+
+        startup = [("import " + module, lambda module=module:
+                    measure_import(module)) for module in IMPORTS]
+        startup.append(("rdp-cred-sniffer.py -h",
+                        lambda: measure_startup(["-h"])))
+        for name, function in startup:
+            if options.filter and not any(f in name for f in options.filter):
+                continue
+            seconds = report["startup"][name] = function()
+            if not options.json:
+                print("%-40s %12.1f ms" % (name, seconds * 1000))
+
+    if options.json:
+        print(json.dumps(report, indent=2))
+    return all(report["checks"].values())
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Loopback end-to-end harness for rdp-cred-sniffer.py
+
+A stand-in RDP server and a scripted client run sessions with Standard RDP
+Security (RC4), TLS and CredSSP/NTLM, first directly and then through the
+sniffer, which is started as a separate process. Reports the handshake
+latency, the latency the sniffer adds per PDU and the bulk throughput.
+Everything stays on 127.0.0.1.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import benchmark
+from seth import crypto, framing, pipeline
+
+
+# Protocols the client asks for, the sniffer's downgrade option and what the
+# server then selects
+SCENARIOS = {
+    "rdp": {"downgrade": 0, "protocol": 0},
+    "tls": {"downgrade": 1, "protocol": 1},
+    "nla": {"downgrade": 3, "protocol": 2},
+}
+REQUESTED_PROTOCOLS = 3
+PING_SIZE = 256
+BULK_PDU_SIZE = 16000
+# A server TSRequest with this byte would be replaced by the CredSSP downgrade
+PUBKEY_AUTH = bytes(range(0x10, 0x20))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    def at(p):
+        return values[min(len(values)-1, int(p * len(values)))]
+    return {"p50": at(.5), "p90": at(.9), "p99": at(.99), "max": values[-1]}
+
+
+async def read_pdu(reader):
+    """Read one TPKT, fast-path or BER encoded PDU"""
+    header = await reader.readexactly(2)
+    if header[0] == 0x03:
+        header += await reader.readexactly(2)
+    elif header[0] == 0x30 and header[1] > 0x80:
+        header += await reader.readexactly(header[1] - 0x80)
+    elif header[1] >= 0x80:
+        header += await reader.readexactly(1)
+    length = framing.pdu_length(header)
+    return header + await reader.readexactly(length - len(header))
+
+
+def ts_request(tag, data):
+    """TSRequest with a single field, like pubKeyAuth or authInfo"""
+    # [MS-CSSP] Ch. 2.2.1
+    return benchmark.ber(0x30, benchmark.ber(0xa0, b"\x02\x01\x06") +
+                         benchmark.ber(tag, benchmark.ber(0x04, data)))
+
+
+def connect_initial(pings, bulk):
+    """Stands in for the MCS Connect Initial, also tells the server what to
+    do in the active phase"""
+    return benchmark.x224_data(b"\x7f\x65\x82\x00\x10" +
+                               struct.pack("<II", pings, bulk) + b"\x01"*8)
+
+
+def session_keys():
+    """Session keys for the fixed client and server random"""
+    session = pipeline.Session()
+    session.crypto.update(client_rand=benchmark.CLIENT_RANDOM,
+                          server_rand=benchmark.SERVER_RANDOM)
+    with benchmark.quiet():
+        crypto.generate_session_keys(session)
+    return session.crypto
+
+
+class Server(object):
+    """Speaks just enough RDP to get a client into the active phase, then
+    answers each input PDU with a small bitmap update. After the pings it
+    sends the bulk data."""
+    def __init__(self, scenario):
+        self.protocol = SCENARIOS[scenario]["protocol"]
+        self.key = crypto.generate_rsa_key(512)
+        self.context = None
+        self.errors = []
+
+
+    async def handle(self, reader, writer):
+        try:
+            await self.run(reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError,
+                asyncio.CancelledError):
+            # The client is gone, or the scenario is over
+            pass
+        except Exception as e:
+            self.errors.append(repr(e))
+        finally:
+            writer.close()
+
+
+    async def run(self, reader, writer):
+        request = await read_pdu(reader)
+        protocol = self.protocol & request[-4]
+        writer.write(benchmark.connection_confirm(protocol))
+        if protocol:
+            await writer.start_tls(self.context)
+        if protocol & 2:
+            # CredSSP: negotiate, challenge, authenticate, public key
+            await read_pdu(reader)
+            writer.write(benchmark.ntlm_challenge())
+            await read_pdu(reader)
+            writer.write(ts_request(0xa3, PUBKEY_AUTH))
+            await read_pdu(reader)
+
+        pdu = await read_pdu(reader)
+        pings, bulk = struct.unpack_from("<II", pdu, 12)
+        rc4 = None
+        if protocol:
+            writer.write(benchmark.mcs_connect_response(protocol=protocol))
+        else:
+            writer.write(benchmark.mcs_connect_response(self.key))
+            pdu = await read_pdu(reader)
+            client_random = crypto.rsa_decrypt(pdu[-72:-8], self.key)
+            if client_random != benchmark.CLIENT_RANDOM:
+                raise ValueError("client random got lost")
+            rc4 = crypto.RC4(session_keys()["server_encrypt_key"])
+        await read_pdu(reader) # Client Info
+        await read_pdu(reader) # Confirm Active
+        writer.write(benchmark.fast_path_bitmap(PING_SIZE, rc4=rc4))
+
+        for _ in range(pings):
+            await read_pdu(reader)
+            writer.write(benchmark.fast_path_bitmap(PING_SIZE, rc4=rc4))
+            await writer.drain()
+        await read_pdu(reader)
+        # Encrypted only once, the sniffer has the same work decrypting it
+        pdu = benchmark.fast_path_bitmap(BULK_PDU_SIZE, rc4=rc4)
+        for _ in range(bulk):
+            writer.write(pdu)
+            await writer.drain()
+        await read_pdu(reader)
+
+
+async def client(port, pings, bulk):
+    """Run one session, returns the handshake time, the round trip times
+    and the duration of the bulk transfer"""
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(benchmark.connection_request(REQUESTED_PROTOCOLS))
+    protocol = (await read_pdu(reader))[-4]
+    if protocol:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        await writer.start_tls(context)
+    if protocol & 2:
+        writer.write(benchmark.ts_request(
+            b"NTLMSSP\x00\x01\x00\x00\x00" + struct.pack("<I", 0xe2088297) +
+            b"\x00"*16
+        ))
+        await read_pdu(reader)
+        writer.write(benchmark.ntlm_authenticate())
+        await read_pdu(reader)
+        writer.write(ts_request(0xa2, b"\x01"*16))
+
+    writer.write(connect_initial(pings, bulk))
+    response = await read_pdu(reader)
+    rc4 = None
+    if not protocol:
+        # Use the key of the certificate, which is the sniffer's
+        offset = response.find(b"RSA1")
+        modulus_length = struct.unpack_from("<I", response, offset+4)[0]
+        e = struct.unpack_from("<I", response, offset+16)[0]
+        n = int.from_bytes(response[offset+20:offset+20+modulus_length],
+                           "little")
+        writer.write(benchmark.security_exchange(crypto.RSAKey(n, e)))
+        rc4 = crypto.RC4(session_keys()["client_encrypt_key"])
+        writer.write(benchmark.encrypted_send_data(
+            benchmark.client_info()[19:], 0x0040, rc4
+        ))
+        writer.write(benchmark.encrypted_send_data(
+            benchmark.confirm_active()[15:], 0, rc4
+        ))
+    else:
+        writer.write(benchmark.client_info())
+        writer.write(benchmark.confirm_active())
+    await read_pdu(reader)
+    handshake = time.perf_counter() - start
+
+    round_trips = []
+    for i in range(pings):
+        start = time.perf_counter()
+        writer.write(benchmark.fast_path_input(
+            [benchmark.key_event(0x10 + i % 26)], rc4
+        ))
+        await read_pdu(reader)
+        round_trips.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    writer.write(benchmark.fast_path_input([benchmark.key_event(0x1c)], rc4))
+    for _ in range(bulk):
+        await read_pdu(reader)
+    transfer = time.perf_counter() - start
+    writer.write(benchmark.fast_path_input([benchmark.key_event(0x01)], rc4))
+    await writer.drain()
+    writer.close()
+    return handshake, round_trips, transfer
+
+
+def generate_certificate(directory):
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+         "-subj", "/CN=harness", "-days", "1",
+         "-keyout", keyfile, "-out", certfile],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return certfile, keyfile
+
+
+@contextlib.contextmanager
+def proxy(target_port, downgrade, certfile, keyfile, log):
+    """Run the sniffer in front of the target, yields its port"""
+    port = free_port()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "rdp-cred-sniffer.py")
+    process = subprocess.Popen(
+        [sys.executable, script, "-b", "127.0.0.1", "-p", str(port),
+         "-c", certfile, "-k", keyfile, "-g", str(downgrade),
+         "127.0.0.1", str(target_port)],
+        stdout=log, stderr=subprocess.STDOUT,
+    )
+    try:
+        for _ in range(100):
+            if process.poll() is not None:
+                raise RuntimeError("the sniffer exited with %d" %
+                                   process.returncode)
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(.05)
+        yield port
+    finally:
+        process.terminate()
+        process.wait()
+
+
+async def measure(port, options):
+    handshakes = []
+    for _ in range(options.sessions):
+        handshake, _, _ = await client(port, 0, 0)
+        handshakes.append(handshake * 1000)
+    results = await asyncio.gather(*[
+        client(port, options.pings, options.bulk)
+        for _ in range(options.parallel)
+    ])
+    round_trips = [t * 1000 for _, rtts, _ in results for t in rtts]
+    transfer = max(t for _, _, t in results)
+    size = options.parallel * options.bulk * (BULK_PDU_SIZE + 6)
+    return {
+        "handshake_ms": percentiles(handshakes),
+        "round_trip_ms": percentiles(round_trips),
+        "throughput_mb_per_s": size / transfer / 1e6,
+    }
+
+
+async def run_scenario(name, options, certfile, keyfile, log):
+    server = Server(name)
+    server.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server.context.load_cert_chain(certfile, keyfile)
+    listener = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    async with listener:
+        direct = await measure(port, options)
+        with proxy(port, SCENARIOS[name]["downgrade"], certfile, keyfile,
+                   log) as proxy_port:
+            proxied = await measure(proxy_port, options)
+    added = {
+        key: proxied["round_trip_ms"][key] - direct["round_trip_ms"][key]
+        for key in direct["round_trip_ms"]
+    }
+    return {"direct": direct, "proxied": proxied,
+            "added_latency_ms": added, "server_errors": server.errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the sniffer on loopback against a stand-in "
+                    "RDP server")
+    parser.add_argument('-s', '--sessions', dest='sessions', type=int,
+        default=10, help="sessions to measure the handshake (default 10)")
+    parser.add_argument('-n', '--pings', dest='pings', type=int,
+        default=1000, help="round trips per session (default 1000)")
+    parser.add_argument('-m', '--bulk', dest='bulk', type=int,
+        default=2000, help="bitmap updates of 16 kB in the bulk transfer "
+                           "(default 2000)")
+    parser.add_argument('-P', '--parallel', dest='parallel', type=int,
+        default=1, help="sessions measured at the same time (default 1)")
+    parser.add_argument('-j', '--json', dest='json', action="store_true",
+        default=False, help="print the results as JSON")
+    parser.add_argument('-l', '--log', dest='log', type=str, default=None,
+        help="write the output of the sniffer to this file")
+    parser.add_argument('scenarios', type=str, nargs='*',
+        help="scenarios to run: %s (default all)" % ", ".join(SCENARIOS))
+    options = parser.parse_args()
+    scenarios = options.scenarios or list(SCENARIOS)
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario: %s" % name)
+
+    report = {}
+    with tempfile.TemporaryDirectory() as directory, \
+            open(options.log or os.devnull, "w") as log:
+        certfile, keyfile = generate_certificate(directory)
+        for name in scenarios:
+            report[name] = asyncio.run(
+                run_scenario(name, options, certfile, keyfile, log)
+            )
+            if options.json:
+                continue
+            r = report[name]
+            print("%s:" % name)
+            for how in ["direct", "proxied"]:
+                print("  %-8s handshake p50 %6.2f ms, round trip p50 %6.3f "
+                      "p99 %6.3f ms, %7.1f MB/s" % (
+                    how, r[how]["handshake_ms"]["p50"],
+                    r[how]["round_trip_ms"]["p50"],
+                    r[how]["round_trip_ms"]["p99"],
+                    r[how]["throughput_mb_per_s"],
+                ))
+            print("  added latency p50 %.3f ms, p90 %.3f ms, p99 %.3f ms" % (
+                r["added_latency_ms"]["p50"], r["added_latency_ms"]["p90"],
+                r["added_latency_ms"]["p99"]))
+            for error in r["server_errors"]:
+                print("  server error: %s" % error)
+
+    if options.json:
+        print(json.dumps(report, indent=2))
+    return not any(r["server_errors"] for r in report.values())
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
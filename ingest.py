@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+"""
+Bulk analysis of RDP sessions in packet captures
+
+Reads pcap and pcapng files as a stream, puts the TCP streams to and from
+the RDP port back together and runs them through the parsers of
+rdp-cred-sniffer.py. The flows are spread across worker processes by their
+addresses, and everything that was extracted is merged into one report.
+
+Only what isn't encrypted can be extracted this way: the negotiation and
+everything that Standard RDP Security doesn't encrypt, e.g. the server's
+certificate. Sessions with Standard RDP Security are decrypted if their
+client random is known, TLS and CredSSP sessions are only listed.
+"""
+
+import argparse
+import ipaddress
+import json
+import multiprocessing
+import os
+import struct
+import sys
+
+from seth import framing, output, pipeline, recording
+
+
+# pcap and pcapng
+PCAP_MAGIC = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_INTERFACE = 1
+PCAPNG_SIMPLE_PACKET = 3
+PCAPNG_ENHANCED_PACKET = 6
+PCAPNG_TSRESOL = 9
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = (12, 14, 101)
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+
+SEQ_MASK = 0xffffffff
+# Out of order data kept per direction before the missing segment is given
+# up on
+MAX_PENDING = 0x100000
+# Packets are sent to the workers in batches, and only this many batches
+# wait for each worker, which bounds the memory
+BATCH_SIZE = 512
+WORKER_QUEUE_SIZE = 8
+
+
+def read_pcap(f, header):
+    """Yield (timestamp, linktype, data) from a classic pcap file"""
+    endian, resolution = PCAP_MAGIC[header]
+    _, _, _, _, _, linktype = struct.unpack(endian + "HHiIII", f.read(20))
+    record = struct.Struct(endian + "IIII")
+    while True:
+        head = f.read(record.size)
+        if len(head) < record.size:
+            return
+        seconds, fraction, caplen, _ = record.unpack(head)
+        data = f.read(caplen)
+        if len(data) < caplen:
+            return
+        yield seconds + fraction * resolution, linktype & 0xffff, data
+
+
+def read_pcapng(f, header):
+    """Yield (timestamp, linktype, data) from a pcapng file"""
+    interfaces = []
+    endian = "<"
+    while True:
+        if header is None:
+            header = f.read(4)
+        if len(header) < 4:
+            return
+        rest = f.read(4)
+        if len(rest) < 4:
+            return
+        if struct.unpack("<I", header)[0] == PCAPNG_SECTION_HEADER:
+            # The byte order magic of the new section comes first
+            body = f.read(4)
+            endian = "<" if body == b"\x4d\x3c\x2b\x1a" else ">"
+            length = struct.unpack(endian + "I", rest)[0]
+            if length < 16:
+                return
+            body += f.read(length - 16)
+            f.read(4)
+            interfaces = []
+            header = None
+            continue
+        type, length = struct.unpack(endian + "II", header + rest)
+        header = None
+        if length < 12:
+            return
+        body = f.read(length - 12)
+        f.read(4)
+        if len(body) < length - 12:
+            return
+        if type == PCAPNG_INTERFACE:
+            linktype = struct.unpack_from(endian + "H", body)[0]
+            resolution = 1e-6
+            offset = 8
+            while offset + 4 <= len(body):
+                code, size = struct.unpack_from(endian + "HH", body, offset)
+                if code == 0:
+                    break
+                if code == PCAPNG_TSRESOL:
+                    value = body[offset+4]
+                    if value & 0x80:
+                        resolution = 2.0 ** -(value & 0x7f)
+                    else:
+                        resolution = 10.0 ** -value
+                offset += 4 + (size + 3) // 4 * 4
+            interfaces.append((linktype, resolution))
+        elif type == PCAPNG_ENHANCED_PACKET:
+            interface, high, low, caplen = struct.unpack_from(
+                endian + "IIII", body)
+            if interface >= len(interfaces):
+                continue
+            linktype, resolution = interfaces[interface]
+            yield ((high << 32 | low) * resolution, linktype,
+                   body[20:20+caplen])
+        elif type == PCAPNG_SIMPLE_PACKET and interfaces:
+            yield 0, interfaces[0][0], body[4:]
+
+
+def read_packets(path):
+    with open(path, "rb", buffering=0x100000) as f:
+        header = f.read(4)
+        if header in PCAP_MAGIC:
+            yield from read_pcap(f, header)
+        elif header == struct.pack("<I", PCAPNG_SECTION_HEADER):
+            yield from read_pcapng(f, header)
+        else:
+            raise ValueError("%s is neither pcap nor pcapng" % path)
+
+
+def decode(linktype, data):
+    """Return (source, destination, TCP header fields, payload) of a TCP
+    packet, or None"""
+    if linktype == LINKTYPE_ETHERNET:
+        ethertype = struct.unpack_from(">H", data, 12)[0]
+        offset = 14
+        while ethertype in ETHERTYPE_VLAN and len(data) >= offset + 4:
+            ethertype = struct.unpack_from(">H", data, offset + 2)[0]
+            offset += 4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        ethertype = struct.unpack_from(">H", data, 14)[0]
+        offset = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        ethertype = struct.unpack_from(">H", data, 0)[0]
+        offset = 20
+    elif linktype == LINKTYPE_NULL:
+        family = struct.unpack_from("=I", data)[0]
+        ethertype = ETHERTYPE_IPV4 if family == 2 else ETHERTYPE_IPV6
+        offset = 4
+    elif linktype in LINKTYPE_RAW:
+        ethertype = ETHERTYPE_IPV4 if data[0] >> 4 == 4 else ETHERTYPE_IPV6
+        offset = 0
+    else:
+        return None
+
+    if ethertype == ETHERTYPE_IPV4:
+        header_length = (data[offset] & 0x0f) * 4
+        total_length, fragment = struct.unpack_from(">HxxH", data, offset+2)
+        # Fragments other than the first are ignored, RDP doesn't send any
+        if data[offset+9] != 6 or fragment & 0x3fff:
+            return None
+        source = ipaddress.IPv4Address(data[offset+12:offset+16])
+        destination = ipaddress.IPv4Address(data[offset+16:offset+20])
+        end = offset + total_length
+        offset += header_length
+    elif ethertype == ETHERTYPE_IPV6:
+        # Extension headers are not supported
+        payload_length = struct.unpack_from(">H", data, offset+4)[0]
+        if data[offset+6] != 6:
+            return None
+        source = ipaddress.IPv6Address(data[offset+8:offset+24])
+        destination = ipaddress.IPv6Address(data[offset+24:offset+40])
+        offset += 40
+        end = offset + payload_length
+    else:
+        return None
+
+    sport, dport, seq, flags = struct.unpack_from(">HHIxxxxxB", data, offset)
+    data_offset = (data[offset+12] >> 4) * 4
+    return ((str(source), sport), (str(destination), dport), flags, seq,
+            data[offset+data_offset:end])
+
+
+class Stream(object):
+    """One direction of a TCP connection. Segments are put back in order,
+    retransmitted data is dropped."""
+    def __init__(self):
+        self.next = None
+        self.pending = {}
+        self.pending_size = 0
+        self.gaps = 0
+
+
+    def add(self, seq, flags, data):
+        """Returns the data that is in order now. None in the list means
+        that data was missing before the chunk after it."""
+        if flags & TCP_SYN:
+            self.next = (seq + 1) & SEQ_MASK
+            return []
+        if self.next is None:
+            # The capture started after the handshake
+            self.next = seq
+        if not data:
+            return []
+        if seq == self.next and not self.pending:
+            self.next = (seq + len(data)) & SEQ_MASK
+            return [data]
+        if len(data) > len(self.pending.get(seq, b"")):
+            self.pending_size += len(data) - len(self.pending.get(seq, b""))
+            self.pending[seq] = data
+        result = []
+        while self.pending:
+            for seq in list(self.pending):
+                overlap = (self.next - seq) & SEQ_MASK
+                if overlap < 0x80000000:
+                    # Starts at or before the next expected byte
+                    data = self.pending.pop(seq)
+                    self.pending_size -= len(data)
+                    if overlap < len(data):
+                        result.append(data[overlap:])
+                        self.next = (seq + len(data)) & SEQ_MASK
+                    break
+            else:
+                if self.pending_size <= MAX_PENDING:
+                    break
+                # Give up on the missing data
+                self.gaps += 1
+                self.next = min(self.pending,
+                                key=lambda s: (s - self.next) & SEQ_MASK)
+                result.append(None)
+        return result
+
+
+class Flow(object):
+    """A TCP connection to the RDP port and what was found in it"""
+    def __init__(self, key, timestamp):
+        self.key = key
+        self.start = timestamp
+        self.session = pipeline.Session()
+        self.session.peer = "%s:%d" % key[1]
+        self.streams = {"Client": Stream(), "Server": Stream()}
+        self.bytes = {"Client": 0, "Server": 0}
+        self.closed = set()
+        self.errors = []
+        self.results = []
+        self.done = False
+
+
+    def add(self, From, timestamp, flags, seq, payload, client_random):
+        for chunk in self.streams[From].add(seq, flags, payload):
+            if chunk is None:
+                # Framing can't go on where data is missing
+                self.session.framers[From] = framing.PDUFramer()
+                continue
+            self.bytes[From] += len(chunk)
+            if self.done:
+                continue
+            try:
+                pipeline.replay(self.session, [recording.Record(
+                    recording.RECORD_DATA, From, False, timestamp, chunk,
+                )], client_random)
+            except Exception as e:
+                self.errors.append("%s: %s" % (type(e).__name__, e))
+            if self.session.nla_enforced:
+                self.done = True
+            if not self.session.phase == framing.PHASE_NEGOTIATION and (
+                    self.session.rdp_protocol):
+                # TLS, nothing more to see
+                self.done = True
+        if flags & TCP_RST:
+            self.closed.update(["Client", "Server"])
+        elif flags & TCP_FIN:
+            self.closed.add(From)
+
+
+    def report(self):
+        return {
+            "file": self.key[0],
+            "client": "%s:%d" % self.key[1],
+            "server": "%s:%d" % self.key[2],
+            "start": self.start,
+            "protocol": self.session.rdp_protocol,
+            "bytes": dict(self.bytes),
+            "gaps": sum(s.gaps for s in self.streams.values()),
+            "errors": self.errors,
+            "results": self.results,
+        }
+
+
+class Collector(object):
+    """Stands in for the sniffer's output in the workers, results go to
+    the flow that is being parsed"""
+    def __init__(self):
+        self.flow = None
+        self.time = None
+
+
+    def log(self, message):
+        pass
+
+
+    def result(self, session, kind, text):
+        self.flow.results.append({"time": self.time, "type": kind,
+                                  "text": text})
+
+
+def worker(packets, results, client_random):
+    """Reassemble and parse the flows sent to this worker"""
+    collector = output.sink = Collector()
+    flows = {}
+    try:
+        try:
+            while True:
+                batch = packets.get()
+                if batch is None:
+                    break
+                for key, From, timestamp, flags, seq, payload in batch:
+                    flow = flows.get(key)
+                    if flow is None:
+                        flow = flows[key] = Flow(key, timestamp)
+                    collector.flow = flow
+                    collector.time = timestamp
+                    flow.add(From, timestamp, flags, seq, payload,
+                             client_random)
+                    if len(flow.closed) == 2:
+                        results.put(flow.report())
+                        del flows[key]
+        except Exception as e:
+            print("Worker failed: %s: %s" % (type(e).__name__, e),
+                  file=sys.stderr)
+            # Keep taking packets, or dispatch() would wait for room in
+            # the queue forever
+            while packets.get() is not None:
+                pass
+        for flow in flows.values():
+            results.put(flow.report())
+    finally:
+        # main() waits for this from every worker
+        results.put(None)
+
+
+def dispatch(paths, port, queues):
+    """Read the captures and send the packets of each flow to the same
+    worker. Returns the number of packets."""
+    batches = [[] for _ in queues]
+    count = 0
+    for path in paths:
+        for timestamp, linktype, data in read_packets(path):
+            try:
+                packet = decode(linktype, data)
+            except (struct.error, IndexError, ValueError):
+                continue
+            if packet is None:
+                continue
+            source, destination, flags, seq, payload = packet
+            if destination[1] == port:
+                key, From = (path, source, destination), "Client"
+            elif source[1] == port:
+                key, From = (path, destination, source), "Server"
+            else:
+                continue
+            count += 1
+            i = hash(key) % len(queues)
+            batches[i].append((key, From, timestamp, flags, seq, payload))
+            if len(batches[i]) >= BATCH_SIZE:
+                queues[i].put(batches[i])
+                batches[i] = []
+    for batch, queue in zip(batches, queues):
+        if batch:
+            queue.put(batch)
+    return count
+
+
+def print_report(flows):
+    for flow in flows:
+        print("%s %s -> %s, protocol %d, %d/%d bytes%s" % (
+            flow["file"], flow["client"], flow["server"], flow["protocol"],
+            flow["bytes"]["Client"], flow["bytes"]["Server"],
+            ", %d gaps" % flow["gaps"] if flow["gaps"] else "",
+        ))
+        for result in flow["results"]:
+            print("    %s" % result["text"].replace("\n", "\n    "))
+        for error in flow["errors"]:
+            print("    Error: %s" % error)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract what can be extracted from RDP sessions in "
+        "packet captures")
+    parser.add_argument('-p', '--port', dest='port', type=int, default=3389,
+        help="TCP port of the RDP service (default 3389)")
+    parser.add_argument('-P', '--processes', dest='processes', type=int,
+        default=os.cpu_count(), help="number of worker processes "
+        "(default: one per CPU)")
+    parser.add_argument('-r', '--client-random', dest='client_random',
+        type=bytes.fromhex, default=None,
+        help="client random as hex, to decrypt Standard RDP Security")
+    parser.add_argument('-j', '--json', dest='json', action="store_true",
+        default=False, help="print the report as JSON")
+    parser.add_argument('--hashes', dest='hashes', type=str, default=None,
+        help="append NTLMv2 hashes to this file, for hashcat or John")
+    parser.add_argument('captures', type=str, nargs='+',
+        help="pcap or pcapng files")
+    options = parser.parse_args()
+
+    results = multiprocessing.Queue()
+    queues = []
+    workers = []
+    for _ in range(max(options.processes, 1)):
+        queues.append(multiprocessing.Queue(WORKER_QUEUE_SIZE))
+        workers.append(multiprocessing.Process(
+            target=worker, args=(queues[-1], results, options.client_random),
+            daemon=True,
+        ))
+        workers[-1].start()
+    try:
+        count = dispatch(options.captures, options.port, queues)
+    finally:
+        for queue in queues:
+            queue.put(None)
+
+    flows = []
+    running = len(workers)
+    while running:
+        flow = results.get()
+        if flow is None:
+            running -= 1
+        else:
+            flows.append(flow)
+    for process in workers:
+        process.join()
+    flows.sort(key=lambda flow: (flow["file"], flow["start"]))
+
+    if options.hashes:
+        with open(options.hashes, "a") as f:
+            for flow in flows:
+                for result in flow["results"]:
+                    if result["type"] == "ntlmv2":
+                        f.write(result["text"] + "\n")
+    if options.json:
+        print(json.dumps(flows, indent=2))
+    else:
+        print_report(flows)
+    print("%d packets, %d flows" % (count, len(flows)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
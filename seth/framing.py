@@ -0,0 +1,217 @@
+"""
+Splitting the data of both sides into PDUs and finding what is of interest
+in them
+"""
+
+import re
+import struct
+
+# Markers searched for by scan_pdu. Plain literals let the regex engine use
+# its fast substring search, which also works on memoryviews.
+NTLMSSP = re.compile(b"NTLMSSP\x00")
+RSA1 = re.compile(b"RSA1")
+MCDN = re.compile(b"McDn")
+# Input Capability Set: type, length, 82 bytes, empty end of imeFileName
+INPUT_CAPS = re.compile(b"\r\x00(?=.{84}\x00\x00)", re.DOTALL)
+# Server core, network and security data of the MCS Connect Response
+SERVER_SECURITY = re.compile(b"\x01\x0c.*?\x03\x0c.*?\x02\x0c", re.DOTALL)
+# RDP Negotiation Failure in the X.224 Connection Confirm, Ch. 2.2.1.2.2
+NLA_FAILURE = b"\x00\x03\x00\x08\x00\x05\x00\x00\x00"
+ZERO_PADDING = b"\x00"*8
+# Larger PDUs are not buffered but forwarded as they come in
+MAX_PDU_LENGTH = 0x100000
+
+# Phases of a connection, each with the markers scan_pdu looks for in it.
+# PDUs are only parsed during the negotiation if the sniffer missed it, so
+# everything is checked then.
+PHASE_NEGOTIATION = "negotiation"
+PHASE_CREDSSP = "credssp"
+PHASE_MCS_CONNECT = "mcs connect"
+PHASE_SECURITY_EXCHANGE = "security exchange"
+PHASE_CLIENT_INFO = "client info"
+PHASE_ACTIVE = "active"
+PHASE_CHECKS = {
+    PHASE_NEGOTIATION: None,
+    PHASE_CREDSSP: {"ntlm_challenge", "ntlm_auth", "credssp_response"},
+    PHASE_MCS_CONNECT: {"server_cert", "mcdn"},
+    # The client random may be missed, don't lose the credentials then
+    PHASE_SECURITY_EXCHANGE: {"client_random", "client_info", "keyboard"},
+    PHASE_CLIENT_INFO: {"client_info", "keyboard"},
+    PHASE_ACTIVE: set(),
+}
+
+
+def is_fast_path(bytes):
+    """True if bytes is one whole fast-path PDU, going by its header"""
+    # Ch. 2.2.8.1.2, 2.2.9.1.2
+    if len(bytes) <= 1 or not bytes[0] % 4 == 0: return False
+    length = bytes[1]
+    if length >= 0x80:
+        if len(bytes) <= 2: return False
+        length = (length - 0x80) * 0x100 + bytes[2]
+    return length == len(bytes)
+
+
+def is_fast_path_output(bytes):
+    """Fast-path output from the server, graphics updates mostly. Unlike
+    for input, the bits after the action are reserved."""
+    # Ch. 2.2.9.1.2
+    return bytes[0] & 0x3f == 0 and is_fast_path(bytes)
+
+
+def pdu_length(bytes, offset=0):
+    """Return the length of the TPKT, BER or fast-path PDU starting at
+    offset, None if its header is incomplete and 0 if it is no PDU at all"""
+    available = len(bytes) - offset
+    if available < 2:
+        return None
+    if bytes[offset] == 0x03 and bytes[offset+1] == 0x00:
+        if available < 4:
+            return None
+        length = struct.unpack_from('>H', bytes, offset+2)[0]
+        if length < 4:
+            return 0
+    elif bytes[offset] == 0x30:
+        length = bytes[offset+1]
+        pad = 2
+        if length >= 0x80:
+            length_bytes = length - 0x80
+            if not 0 < length_bytes <= 4:
+                return 0
+            if available < 2+length_bytes:
+                return None
+            length = int.from_bytes(bytes[offset+2:offset+2+length_bytes],
+                                    byteorder='big')
+            pad = 2 + length_bytes
+        length += pad
+    elif bytes[offset] % 4 == 0: #fastpath
+        length = bytes[offset+1]
+        if length >= 0x80:
+            if available < 3:
+                return None
+            length = struct.unpack_from('>H', bytes, offset+1)[0]
+            length -= 0x80*0x100
+        if length < 2:
+            return 0
+    else:
+        return 0
+    if length > MAX_PDU_LENGTH:
+        return 0
+    return length
+
+
+class PDUFramer(object):
+    """Splits the stream of one direction into complete PDUs. A PDU that is
+    cut off at the end of a read is kept until the rest of it arrives."""
+    def __init__(self):
+        self.buffer = bytearray()
+        self.needed = 0
+        # False after data that could not be framed, until a read starts
+        # with a complete TPKT or fast-path PDU again
+        self.synced = True
+
+
+    def feed(self, data):
+        """Add data to the stream and return the complete PDUs as
+        memoryviews"""
+        if not self.synced:
+            # Never wait for more data on the strength of a length that may
+            # be anything, that could stall the session
+            length = pdu_length(data)
+            if not length or length > len(data) or data[0] == 0x30:
+                return [memoryview(data)]
+            self.synced = True
+        if self.buffer:
+            self.buffer += data
+            if len(self.buffer) < self.needed:
+                return []
+            # The old buffer is never resized again while views of it exist
+            data, self.buffer = self.buffer, bytearray()
+        view = memoryview(data)
+        end = len(view)
+        offset = 0
+        pdus = []
+        while offset < end:
+            length = pdu_length(view, offset)
+            if length == 0:
+                # Not something we can frame, so pass the rest on as it is
+                # and look for the start of a PDU in the next reads
+                pdus.append(view[offset:])
+                self.synced = False
+                break
+            elif length is None or offset + length > end:
+                self.buffer = bytearray(view[offset:])
+                self.needed = length or 0
+                break
+            pdus.append(view[offset:offset+length])
+            offset += length
+        return pdus
+
+
+def find_client_random(bytes):
+    """Return the offset of the length field of the encrypted client random
+    in a Security Exchange PDU, or None"""
+    # The random is padded with eight zero bytes and fills the rest of the
+    # PDU, so its length field must be somewhere in the headers
+    length = len(bytes)
+    if length < 16 or not bytes[-8:] == ZERO_PADDING:
+        return None
+    for i in range(7, min(length-4, 32)):
+        if struct.unpack_from('<I', bytes, i)[0] == length-i-4:
+            return i
+    return None
+
+
+def scan_pdu(bytes, From="Client", checks=None):
+    """Scan a PDU once and return a dict mapping the name of each marker
+    found to the offset the matching extract_* or tamper function expects.
+    Only the markers in checks are looked for, all of them if it is None."""
+    hits = {}
+    if checks is None or "ntlm_challenge" in checks or "ntlm_auth" in checks:
+        # Later matches win, just like a greedy ".*" would
+        for m in NTLMSSP.finditer(bytes):
+            offset = m.end()
+            if bytes[offset+1:offset+4] == b"\x00\x00\x00":
+                if bytes[offset] == 2:
+                    hits["ntlm_challenge"] = offset+4
+                elif bytes[offset] == 3:
+                    hits["ntlm_auth"] = offset+4
+
+    if checks is None or "server_cert" in checks:
+        m = RSA1.search(bytes)
+        if m:
+            m = SERVER_SECURITY.search(bytes, 0, m.start())
+            if m:
+                hits["server_cert"] = m.end()
+
+    if checks is None or "mcdn" in checks:
+        for m in MCDN.finditer(bytes):
+            offset = m.end()
+            if bytes[offset+1:offset+3] == b"\x01\x0c":
+                hits["mcdn"] = offset+3
+
+    # "0x0040 MUST be present"
+    if ((checks is None or "client_info" in checks)
+            and len(bytes) >= 32 and bytes[15] == 0x40):
+        hits["client_info"] = 15
+
+    if From == "Client":
+        if checks is None or "keyboard" in checks:
+            for m in INPUT_CAPS.finditer(bytes):
+                hits["keyboard"] = m.end()
+        if checks is None or "client_random" in checks:
+            offset = find_client_random(bytes)
+            if offset is not None:
+                hits["client_random"] = offset
+
+    if ((checks is None or "nla_failure" in checks)
+            and bytes[:2] == b"\x03\x00" and bytes[-9:] == NLA_FAILURE):
+        hits["nla_failure"] = len(bytes) - 9
+
+    # A TSRequest from the server after the NTLM challenge
+    if ((checks is None or "credssp_response" in checks)
+            and From == "Server" and len(bytes) > 3 and bytes[0] == 0x30
+            and bytes[2] == 0xa0 and 0x6d in bytes[3:]):
+        hits["credssp_response"] = 0
+
+    return hits
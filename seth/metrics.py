@@ -0,0 +1,131 @@
+"""
+Statistics of the forwarding pipeline, see --stats
+"""
+
+import json
+import time
+
+from seth import output
+
+# Histogram buckets for durations up to 2**23 microseconds, about 8 seconds
+STATS_BUCKETS = 24
+
+
+class Stats(object):
+    """Counters and latency histograms of the forwarding pipeline. Bucket i
+    of a histogram counts the durations below 2**i microseconds."""
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.totals = {}
+
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = [0] * STATS_BUCKETS
+            self.totals[name] = 0
+        bucket = int(seconds * 1e6).bit_length()
+        histogram[min(bucket, STATS_BUCKETS - 1)] += 1
+        self.totals[name] += seconds
+
+
+    def timed(self, name, function):
+        """Wrap a function taking (session, data, From) so that each call
+        is counted and timed, by direction"""
+        names = {From: "%s %s" % (name, From.lower())
+                 for From in ["Client", "Server"]}
+        perf_counter = time.perf_counter
+        observe = self.observe
+
+        def wrapper(session, data, From="Client", *args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(session, data, From, *args, **kwargs)
+            finally:
+                observe(names[From], perf_counter() - start)
+        return wrapper
+
+
+    def percentile(self, name, fraction):
+        """Upper bound of the bucket the percentile falls into, in
+        microseconds"""
+        histogram = self.histograms[name]
+        rank = fraction * sum(histogram)
+        seen = 0
+        for i, n in enumerate(histogram):
+            seen += n
+            if seen >= rank:
+                return 2**i
+        return 2**(STATS_BUCKETS - 1)
+
+
+    def as_dict(self):
+        return {
+            "uptime": time.time() - self.started,
+            "counters": dict(self.counters),
+            "histograms": {
+                name: {
+                    "count": sum(histogram),
+                    "total": self.totals[name],
+                    "buckets": list(histogram),
+                } for name, histogram in self.histograms.items()
+            },
+        }
+
+
+    def report(self):
+        lines = ["Statistics after %.0f s" % (time.time() - self.started)]
+        for name, value in sorted(self.counters.items()):
+            lines.append("  %-30s %12d" % (name, value))
+        for name, histogram in sorted(self.histograms.items()):
+            count = sum(histogram)
+            lines.append(
+                "  %-30s %12d calls, mean %8.1f us, p50 < %d us, "
+                "p90 < %d us, p99 < %d us" % (
+                    name, count, self.totals[name] / count * 1e6,
+                    self.percentile(name, .5), self.percentile(name, .9),
+                    self.percentile(name, .99),
+                ))
+        return "\n".join(lines)
+
+
+# Set by enable_stats(), everything checks for None so that the statistics
+# cost nothing when they are off
+stats = None
+
+
+def enable_stats():
+    """Start collecting statistics, the stages of the pipeline are timed by
+    replacing their functions with wrappers. Other modules call them through
+    their module for this reason."""
+    global stats
+    import seth.crypto, seth.pipeline, seth.proxy, seth.tamper
+    stats = Stats()
+    # All the handling of one read, including the stages below and sending
+    seth.proxy.receive_data = stats.timed("receive_data",
+                                          seth.proxy.receive_data)
+    seth.pipeline.parse_rdp_packet = stats.timed(
+        "parse_rdp", seth.pipeline.parse_rdp_packet)
+    seth.crypto.decrypt = stats.timed("decrypt", seth.crypto.decrypt)
+    seth.tamper.tamper_data = stats.timed("tamper_data",
+                                          seth.tamper.tamper_data)
+    seth.proxy.send = stats.timed("send", seth.proxy.send)
+
+
+def dump_stats():
+    output.log(stats.report())
+
+
+async def serve_stats(reader, writer):
+    """Send the statistics as JSON to whoever connects to the socket"""
+    writer.write(json.dumps(stats.as_dict()).encode() + b"\n")
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
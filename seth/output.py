@@ -0,0 +1,193 @@
+"""
+Messages and results for the terminal and the output files. Everything goes
+through the functions at the end of this module, so a tool can replace the
+sink to collect the results itself.
+"""
+
+import json
+import queue
+import sys
+import threading
+import time
+
+# Results are written by a background thread, in batches of this many bytes
+# or after this many seconds
+OUTPUT_QUEUE_SIZE = 10000
+OUTPUT_FLUSH_SIZE = 0x10000
+OUTPUT_FLUSH_INTERVAL = 1.0
+
+
+class OutputSink(object):
+    """Writes messages and results to the terminal and the output files.
+    Once started, callers only put records into a bounded queue and a
+    background thread writes them, so a slow terminal or pipe never stalls
+    a session. When the queue is full, messages are dropped, but results
+    go to an unbounded overflow that the thread writes once it has caught
+    up. Until then records are written right away."""
+    def __init__(self, size=OUTPUT_QUEUE_SIZE):
+        self.queue = queue.Queue(size)
+        self.thread = None
+        self.files = {}
+        # Counted by whoever logs, reported by the background thread
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+        # Results that didn't fit into the queue, in order
+        self.overflow = []
+        self.overflow_lock = threading.Lock()
+
+
+    def start(self, output=None, hashes=None, keys=None):
+        for name, path in [("output", output), ("hashes", hashes),
+                           ("keys", keys)]:
+            if path:
+                self.files[name] = open(path, "a", buffering=OUTPUT_FLUSH_SIZE)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+    def put(self, record):
+        if self.thread is None:
+            self.write(record)
+            self.flush()
+            return
+        if record[1] is not None:
+            # Results are what the sniffer is for, never lose one, but
+            # never wait for the thread either
+            with self.overflow_lock:
+                if not self.overflow:
+                    try:
+                        self.queue.put_nowait(record)
+                        return
+                    except queue.Full:
+                        pass
+                self.overflow.append(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+
+    def log(self, message):
+        """A status message for the terminal"""
+        self.put((time.time(), None, message, None))
+
+
+    def result(self, session, kind, text):
+        """Something that was extracted from a session, e.g. credentials"""
+        self.put((time.time(), kind, text, session.peer))
+
+
+    def write(self, record):
+        """Write one record, returns the number of bytes written"""
+        timestamp, kind, text, peer = record
+        if kind is None:
+            line = text + "\n"
+        else:
+            line = "\033[31m%s\033[0m\n" % text
+        sys.stdout.write(line)
+        size = len(line)
+        if kind is None:
+            return size
+        f = self.files.get("output")
+        if f is not None:
+            line = json.dumps({"time": timestamp, "peer": peer, "type": kind,
+                               "text": text}) + "\n"
+            f.write(line)
+            size += len(line)
+        f = self.files.get("hashes")
+        if f is not None and kind == "ntlmv2":
+            f.write(text + "\n")
+            size += len(text) + 1
+        f = self.files.get("keys")
+        if f is not None and kind == "keys":
+            stamp = time.strftime("%Y-%m-%d %H:%M:%S",
+                                  time.localtime(timestamp))
+            for key in text.splitlines():
+                line = "%s %s %s\n" % (stamp, peer, key)
+                f.write(line)
+                size += len(line)
+        return size
+
+
+    def flush(self):
+        sys.stdout.flush()
+        for f in self.files.values():
+            f.flush()
+
+
+    def take_overflow(self):
+        with self.overflow_lock:
+            records, self.overflow = self.overflow, []
+        return records
+
+
+    def run(self):
+        pending = 0
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+            if self.overflow and self.queue.empty():
+                # Results only go to the overflow while it or the queue is
+                # full, so this keeps their order
+                for record in self.take_overflow():
+                    pending += self.write(record)
+                if deadline is None:
+                    deadline = time.monotonic() + OUTPUT_FLUSH_INTERVAL
+                continue
+            try:
+                record = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                record = False
+            if record:
+                pending += self.write(record)
+                if deadline is None:
+                    deadline = time.monotonic() + OUTPUT_FLUSH_INTERVAL
+            if self.dropped and (not record or pending >= OUTPUT_FLUSH_SIZE):
+                with self.dropped_lock:
+                    dropped, self.dropped = self.dropped, 0
+                self.write((time.time(), None,
+                            "Output queue full, %d records dropped" % dropped,
+                            None))
+            if not record or pending >= OUTPUT_FLUSH_SIZE:
+                self.flush()
+                pending = 0
+                deadline = None
+            if record is None:
+                for record in self.take_overflow():
+                    self.write(record)
+                self.flush()
+                return
+
+
+sink = OutputSink()
+
+
+def start(output=None, hashes=None, keys=None):
+    sink.start(output, hashes, keys)
+
+
+def stop():
+    sink.stop()
+
+
+def log(message):
+    sink.log(message)
+
+
+def result(session, kind, text):
+    sink.result(session, kind, text)
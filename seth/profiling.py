@@ -0,0 +1,170 @@
+"""
+Profiling of a running sniffer on demand, see --profile-dir
+
+Each hook is switched on and off by a signal, and writes a report to a
+timestamped file in the directory when it is switched off. While a hook is
+off, nothing of it is installed, so it costs nothing.
+"""
+
+import ast
+import inspect
+import os
+import time
+
+from seth import output
+
+# Allocations are attributed to the innermost of these functions that is on
+# their stack, as (module, qualified name, label)
+ALLOCATION_STAGES = [
+    ("seth.proxy", "receive_data", "read"),
+    ("seth.pipeline", "forward_data", "forward_data"),
+    ("seth.pipeline", "parse_rdp", "parse_rdp"),
+    ("seth.crypto", "RC4.decrypt", "RC4.decrypt"),
+    ("seth.tamper", "tamper_data", "tamper_data"),
+]
+ALLOCATION_FRAMES = 32
+ALLOCATION_TOP = 20
+CPU_TOP = 40
+
+# Set by set_directory()
+directory = None
+
+profiler = None
+forward_data = None
+cpu_started = None
+snapshot = None
+allocations_started = None
+
+
+def set_directory(path):
+    global directory
+    os.makedirs(path, exist_ok=True)
+    directory = path
+
+
+def report_path(kind, extension):
+    """A new file name with the time, numbered if there are several
+    reports in one second"""
+    base = os.path.join(directory, "seth-%s-%s" % (
+        kind, time.strftime("%Y%m%d-%H%M%S")))
+    path = "%s.%s" % (base, extension)
+    n = 1
+    while os.path.exists(path):
+        n += 1
+        path = "%s-%d.%s" % (base, n, extension)
+    return path
+
+
+def profile_calls(function):
+    def wrapper(*args, **kwargs):
+        profiler.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profiler.disable()
+    return wrapper
+
+
+def toggle_cpu():
+    """Start or stop cProfile around forward_data(). The proxy calls it
+    through its module, so it can be replaced while the sniffer runs."""
+    global profiler, forward_data, cpu_started
+    import cProfile
+    import pstats
+    import seth.pipeline
+    if profiler is None:
+        profiler = cProfile.Profile()
+        forward_data = seth.pipeline.forward_data
+        seth.pipeline.forward_data = profile_calls(forward_data)
+        cpu_started = time.time()
+        output.log("CPU profiling started")
+        return
+    seth.pipeline.forward_data = forward_data
+    path = report_path("cpu", "prof")
+    profiler.dump_stats(path)
+    with open(path[:-len("prof")] + "txt", "w") as f:
+        f.write("CPU profile of forward_data() over %.0f s\n\n"
+                % (time.time() - cpu_started))
+        # dump_stats() left the statistics in profiler.stats
+        if profiler.stats:
+            pstats.Stats(profiler, stream=f).sort_stats(
+                "cumulative").print_stats(CPU_TOP)
+    profiler = forward_data = None
+    output.log("CPU profile written to %s" % path)
+
+
+def stage_lines():
+    """Map the source files of the stages to their line ranges"""
+    import importlib
+    result = {}
+    for module, name, label in ALLOCATION_STAGES:
+        filename = inspect.getsourcefile(importlib.import_module(module))
+        with open(filename) as f:
+            tree = ast.parse(f.read())
+        # Look the function up in the source, the statistics may have
+        # replaced it with a wrapper
+        body = tree.body
+        for part in name.split("."):
+            node = next(n for n in body if getattr(n, "name", None) == part)
+            body = node.body
+        result.setdefault(filename, []).append(
+            (node.lineno, node.end_lineno, label))
+    return result
+
+
+def stage_of(traceback, lines):
+    """The label of the innermost stage in the traceback, or None"""
+    for frame in reversed(traceback):
+        for first, last, label in lines.get(frame.filename, ()):
+            if first <= frame.lineno <= last:
+                return label
+    return None
+
+
+def allocation_report(old, new, seconds):
+    lines = stage_lines()
+    stages = {label: [0, 0] for _, _, label in ALLOCATION_STAGES}
+    stages[None] = [0, 0]
+    for diff in new.compare_to(old, "traceback"):
+        totals = stages[stage_of(diff.traceback, lines)]
+        totals[0] += diff.size_diff
+        totals[1] += diff.count_diff
+    report = ["Allocations over %.0f s, by stage" % seconds]
+    for label, (size, count) in sorted(stages.items(),
+                                       key=lambda item: -item[1][0]):
+        report.append("  %-26s %+12d bytes %+10d blocks" % (
+            label or "elsewhere", size, count))
+    report.append("")
+    report.append("Top %d lines" % ALLOCATION_TOP)
+    for diff in new.compare_to(old, "lineno")[:ALLOCATION_TOP]:
+        report.append("  %s" % diff)
+    return "\n".join(report) + "\n"
+
+
+def toggle_allocations():
+    """Start tracing allocations, or compare them to the start and stop"""
+    global snapshot, allocations_started
+    import tracemalloc
+    if snapshot is None:
+        tracemalloc.start(ALLOCATION_FRAMES)
+        snapshot = tracemalloc.take_snapshot()
+        allocations_started = time.time()
+        output.log("Allocation tracing started")
+        return
+    new = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)])
+    tracemalloc.stop()
+    path = report_path("memory", "txt")
+    with open(path, "w") as f:
+        f.write(allocation_report(snapshot, new,
+                                  time.time() - allocations_started))
+    snapshot = None
+    output.log("Allocation report written to %s" % path)
+
+
+def stop():
+    """Write the reports of the hooks that are still on"""
+    if profiler is not None:
+        toggle_cpu()
+    if snapshot is not None:
+        toggle_allocations()
@@ -0,0 +1,355 @@
+"""
+The proxy between the client and the target, on asyncio. Each connection
+from a client gets a Session with two Legs, one for each side.
+"""
+
+import asyncio
+import os
+import signal
+import ssl
+import time
+
+from seth import metrics, output, pipeline, profiling
+from seth.framing import PHASE_CREDSSP, PHASE_MCS_CONNECT, PHASE_NEGOTIATION
+from seth.pipeline import Session
+from seth.recording import Capture, Recorder, dump_data, write_capture
+from seth.tamper import CREDSSP_DOWNGRADE, downgrade_auth
+
+# Receive buffers are large enough for a burst of bitmap updates, each leg
+# keeps a few of them around for reuse
+READ_BUFFER_SIZE = 0x40000
+READ_BUFFER_POOL_SIZE = 4
+
+# The options from the command line, set by seth.cli
+args = None
+
+# Sessions with a debug capture, to dump them all on SIGUSR2
+live_sessions = set()
+
+
+def write_captures():
+    for session in list(live_sessions):
+        write_capture(session, "signal")
+
+
+def handle_protocol_negotiation(session, data, From):
+    """Returns the X.224 Connection Request or Confirm to forward"""
+    data = bytes(data)
+    dump_data(session, data, From=From)
+    if From == "Client":
+        data = downgrade_auth(session, data, args.downgrade)
+    else:
+        pipeline.check_nla_failure(session, data)
+    return data
+
+
+# Set by create_ssl_contexts()
+server_context = None
+client_context = None
+
+
+def create_ssl_contexts():
+    """Load the certificate and set up both TLS legs once, the contexts
+    also hold the session caches"""
+    global server_context
+    global client_context
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(args.certfile, args.keyfile)
+
+    client_context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+    try:
+        client_context.set_ciphers("RC4-SHA")
+    except ssl.SSLError:
+        # Current OpenSSL versions don't have RC4 anymore
+        pass
+
+
+class ResumingContext(ssl.SSLContext):
+    """Client context that resumes the last TLS session with the target.
+    The event loop's start_tls() has no way of passing the session along."""
+    def wrap_bio(self, incoming, outgoing, server_side=False,
+                 server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = ssl_sessions.get((args.target_host, args.target_port))
+        return super().wrap_bio(incoming, outgoing, server_side=server_side,
+                                server_hostname=server_hostname,
+                                session=session)
+
+
+# TLS sessions with the targets, so reconnects can resume them
+ssl_sessions = {}
+
+
+def save_ssl_session(session):
+    leg = session.legs.get("Server")
+    if leg is None or leg.transport is None:
+        return
+    ssl_object = leg.transport.get_extra_info("ssl_object")
+    if ssl_object is not None and ssl_object.session:
+        ssl_sessions[(args.target_host, args.target_port)] = (
+            ssl_object.session
+        )
+
+
+async def start_tls(leg, context, server_side=False):
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    leg.transport = await loop.start_tls(leg.transport, leg, context,
+                                         server_side=server_side)
+    # The new transport reads right away, unless something else still
+    # needs the leg paused
+    leg.paused.discard("handshake")
+    if leg.paused:
+        leg.transport.pause_reading()
+    elapsed = time.perf_counter() - start
+    resumed = leg.transport.get_extra_info("ssl_object").session_reused
+    stats = metrics.stats
+    if stats is not None:
+        stats.count("tls handshakes %s" % leg.From.lower())
+        if resumed:
+            stats.count("tls resumptions")
+        stats.observe("tls handshake %s" % leg.From.lower(), elapsed)
+    output.log("TLS handshake with the %s took %.1f ms%s" % (
+        "client" if leg.From == "Client" else "target",
+        elapsed * 1000,
+        " (resumed)" if resumed else "",
+    ))
+
+
+async def enableSSL(session):
+    output.log("Enable SSL")
+    # Both handshakes run at the same time, neither leg waits for the other
+    results = await asyncio.gather(
+        start_tls(session.legs["Client"], server_context, server_side=True),
+        start_tls(session.legs["Server"], client_context),
+        return_exceptions=True,
+    )
+    for e in results:
+        if isinstance(e, ConnectionResetError):
+            output.log("Connection lost")
+        elif isinstance(e, ssl.SSLEOFError):
+            output.log("SSL EOF Error during handshake")
+        elif isinstance(e, Exception):
+            output.log("SSLError: %s" % str(e))
+    if any(results):
+        return close(session)
+    save_ssl_session(session)
+
+    backlog, session.backlog = session.backlog, None
+    for data, From in backlog:
+        receive_data(session, data, From)
+
+
+def close(session):
+    if session.closed:
+        return False
+    session.closed = True
+    live_sessions.discard(session)
+    write_capture(session, "session end")
+    if session.recorder is not None:
+        session.recorder.close()
+    # With TLS 1.3 the session ticket only arrives after the handshake
+    save_ssl_session(session)
+    for leg in session.legs.values():
+        if leg.transport is not None:
+            leg.transport.close()
+    return False
+
+
+def receive_data(session, data, From):
+    to_leg = session.legs["Server" if From == "Client" else "Client"]
+    if session.backlog is not None:
+        # The TLS handshakes are still running, and the receive buffer will
+        # be reused in the meantime
+        session.backlog.append((bytes(data), From))
+        return
+    if session.phase == PHASE_NEGOTIATION:
+        data = handle_protocol_negotiation(session, data, From)
+        if session.nla_enforced:
+            # Let the client see why, then end only this session
+            to_leg.transport.write(data)
+            return close(session)
+        if From == "Server":
+            if session.rdp_protocol & 2:
+                session.phase = PHASE_CREDSSP
+            else:
+                session.phase = PHASE_MCS_CONNECT
+            if not session.rdp_protocol == 0:
+                # Keep the client hello in the socket until start_tls()
+                session.legs["Client"].pause("handshake")
+                session.backlog = []
+                to_leg.transport.write(data)
+                asyncio.ensure_future(enableSSL(session))
+                return
+        to_leg.transport.write(data)
+    else:
+        chunks = pipeline.forward_data(session, data, From)
+        if session.nla_enforced:
+            # Only this session ends, the others go on
+            return close(session)
+        send(session, chunks, From)
+
+
+def send(session, chunks, From):
+    to_leg = session.legs["Server" if From == "Client" else "Client"]
+    to_leg.transport.writelines(chunks)
+
+
+def buffer_in_use(buffer):
+    """True if a memoryview of the buffer is still alive, e.g. because a
+    transport hasn't sent the data yet"""
+    try:
+        buffer.append(0)
+    except BufferError:
+        return True
+    del buffer[-1]
+    return False
+
+
+class Leg(asyncio.BufferedProtocol):
+    """One of the two connections of a session, From is the side that
+    sends the data received here. Data is received straight into a buffer
+    from the leg's pool and passed on as memoryviews."""
+    def __init__(self, session, From):
+        self.session = session
+        self.From = From
+        self.transport = None
+        self.buffers = []
+        self.buffer = None
+        # Why reading is paused, it only goes on once all reasons are gone
+        self.paused = set()
+        session.legs[From] = self
+
+
+    def other(self):
+        return self.session.legs.get("Server" if self.From == "Client"
+                                     else "Client")
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.From == "Client":
+            peername = transport.get_extra_info("peername")
+            self.session.peer = "%s:%d" % peername[:2]
+            self.session.started = time.perf_counter()
+            if args.debug:
+                self.session.capture = Capture(sample=args.debug_sample)
+                live_sessions.add(self.session)
+            if args.record:
+                self.session.recorder = Recorder(os.path.join(
+                    args.record, "%s-%s-%d.rec" % (
+                        time.strftime("%Y%m%d-%H%M%S"), peername[0],
+                        peername[1],
+                    )))
+            if metrics.stats is not None:
+                metrics.stats.count("sessions")
+            output.log("Connection received from " + peername[0])
+            # Nothing can be forwarded until the target is connected
+            self.pause("connect")
+            asyncio.ensure_future(open_connection(self.session))
+
+
+    def get_buffer(self, sizehint):
+        for buffer in self.buffers:
+            if not buffer_in_use(buffer):
+                break
+        else:
+            buffer = bytearray(READ_BUFFER_SIZE)
+            if len(self.buffers) < READ_BUFFER_POOL_SIZE:
+                self.buffers.append(buffer)
+        self.buffer = buffer
+        return memoryview(buffer)
+
+
+    def buffer_updated(self, nbytes):
+        if metrics.stats is not None:
+            metrics.stats.count("bytes " + self.From.lower(), nbytes)
+        try:
+            receive_data(self.session, memoryview(self.buffer)[:nbytes],
+                         self.From)
+        except Exception:
+            write_capture(self.session, "exception")
+            raise
+
+
+    def connection_lost(self, exc):
+        if isinstance(exc, ssl.SSLError):
+            if "alert access denied" in str(exc):
+                output.log("TLS alert access denied, Downgrading CredSSP")
+                self.session.legs["Client"].transport.write(CREDSSP_DOWNGRADE)
+            elif "alert internal error" in str(exc):
+                # openssl connecting to windows7 with AES doesn't seem to
+                # work
+                output.log("TLS alert internal error received, make sure to use RC4-SHA")
+            else:
+                output.log("SSLError: %s" % str(exc))
+        elif exc is not None:
+            output.log("Connection lost")
+        close(self.session)
+
+
+    def pause(self, reason):
+        if not self.paused and self.transport is not None:
+            self.transport.pause_reading()
+        self.paused.add(reason)
+
+
+    def resume(self, reason):
+        self.paused.discard(reason)
+        if not self.paused and self.transport is not None:
+            self.transport.resume_reading()
+
+
+    def pause_writing(self):
+        # The peer doesn't keep up, so stop reading from the other side
+        # instead of buffering without limit
+        other = self.other()
+        if other is not None:
+            other.pause("backpressure")
+
+
+    def resume_writing(self):
+        other = self.other()
+        if other is not None:
+            other.resume("backpressure")
+
+
+async def open_connection(session):
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.create_connection(lambda: Leg(session, "Server"),
+                                     args.target_host, args.target_port)
+    except OSError as e:
+        output.log("Connection to target failed: %s" % str(e))
+        return close(session)
+    if session.closed:
+        # The client is already gone
+        return session.legs["Server"].transport.close()
+    session.legs["Client"].resume("connect")
+
+
+async def serve():
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: Leg(Session(), "Client"),
+                                      args.bind_ip, args.listen_port,
+                                      reuse_address=True)
+    output.log("Waiting for connection")
+    # Stop on SIGTERM as on Ctrl-C, so the output gets written
+    stopped = loop.create_future()
+    loop.add_signal_handler(signal.SIGTERM,
+                            lambda: stopped.done() or stopped.set_result(None))
+    if metrics.stats is not None:
+        loop.add_signal_handler(signal.SIGUSR1, metrics.dump_stats)
+    if args.debug:
+        loop.add_signal_handler(signal.SIGUSR2, write_captures)
+    if profiling.directory is not None:
+        loop.add_signal_handler(signal.SIGRTMIN, profiling.toggle_cpu)
+        loop.add_signal_handler(signal.SIGRTMIN + 1,
+                                profiling.toggle_allocations)
+    if args.stats_socket:
+        await asyncio.start_unix_server(metrics.serve_stats,
+                                        args.stats_socket)
+    async with server:
+        await stopped
